@@ -2,6 +2,7 @@ import random
 import numpy as np
 from scipy.special import expit
 import fastrand, math
+import torch
 
 
 #Neuroevolution SSNE
@@ -14,6 +15,9 @@ class SSNE:
         if self.num_elitists < 1: self.num_elitists = 1
 
         self.rl_policy = None
+        # The crossover masks are drawn on the CPU and moved to the device of the parameters
+        self.generator = torch.Generator()
+        self.generator.manual_seed(args.seed)
         self.selection_stats = {'elite': 0, 'selected': 0, 'discarded':0, 'total':0.0000001}
 
     def selection_tournament(self, index_rank, num_offsprings, tournament_size):
@@ -36,39 +40,68 @@ class SSNE:
         if weight < -mag: weight = -mag
         return weight
 
-    def crossover_inplace(self, gene1, gene2):
-        for param1, param2 in zip(gene1.parameters(), gene2.parameters()):
-
-            # References to the variable tensors
-            W1 = param1.data
-            W2 = param2.data
-
-            if len(W1.shape) == 2: #Weights no bias
-                num_variables = W1.shape[0]
-                # Crossover opertation [Indexed by row]
-                num_cross_overs = fastrand.pcg32bounded(num_variables * 2)  # Lower bounded on full swaps
-                for i in range(num_cross_overs):
-                    receiver_choice = random.random()  # Choose which gene to receive the perturbation
-                    if receiver_choice < 0.5:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W1[ind_cr, :] = W2[ind_cr, :]
-                    else:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W2[ind_cr, :] = W1[ind_cr, :]
-
-            elif len(W1.shape) == 1: #Bias
-                num_variables = W1.shape[0]
-                # Crossover opertation [Indexed by row]
-                num_cross_overs = fastrand.pcg32bounded(num_variables)  # Lower bounded on full swaps
-                for i in range(num_cross_overs):
-                    receiver_choice = random.random()  # Choose which gene to receive the perturbation
-                    if receiver_choice < 0.5:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W1[ind_cr] = W2[ind_cr]
-                    else:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W2[ind_cr] = W1[ind_cr]
+    def crossover_masks(self, batch, num_rows, max_crossovers):
+        """
+        Draws the row swaps of a batch of crossovers between tensors with num_rows rows. Each crossover makes
+        a number of swaps uniform in [0, max_crossovers), each one copying a random row from one parent to the
+        other. Once a row has been copied the two parents hold the same values, so later swaps of that row
+        change nothing and the result of the sequential swaps only depends on the first swap of each row.
+        :return: two (batch, num_rows) masks, the rows gene1 takes from gene2 and the rows gene2 takes from gene1
+        """
+        num_cross_overs = torch.randint(max_crossovers, (batch, 1), generator=self.generator)  # Lower bounded on full swaps
+        rows = torch.randint(num_rows, (batch, max_crossovers), generator=self.generator)
+        to_gene1 = torch.rand(batch, max_crossovers, generator=self.generator) < 0.5  # Choose which gene receives the row
+
+        # Swaps sorted by row and then by position, the first swap of a row starts its run. The swaps after
+        # num_cross_overs go to the extra row num_rows, which is dropped
+        positions = torch.arange(max_crossovers).expand(batch, max_crossovers)
+        rows = torch.where(positions < num_cross_overs, rows, torch.full_like(rows, num_rows))
+        order = rows * max_crossovers + positions
+        perm = order.sort(1)[1]
+        sorted_rows = rows.gather(1, perm)
+        first = torch.ones_like(sorted_rows, dtype=torch.bool)
+        first[:, 1:] = sorted_rows[:, 1:] != sorted_rows[:, :-1]
+        first_to_gene1 = to_gene1.gather(1, perm)
+
+        # Only the first swap of each row writes to it, the others write to the dropped row
+        target = torch.where(first, sorted_rows, torch.full_like(sorted_rows, num_rows))
+        masks = torch.zeros(2, batch, num_rows + 1, dtype=torch.bool)
+        masks[0].scatter_(1, target, first & first_to_gene1)
+        masks[1].scatter_(1, target, first & ~first_to_gene1)
+        return masks[0, :, :num_rows], masks[1, :, :num_rows]
+
+    def crossover_batch(self, pairs):
+        """
+        Row crossover between the two genes of each pair, all the pairs at once
+        :param pairs: list of (gene1, gene2), a gene can only appear once
+        """
+        if len(pairs) == 0:
+            return
+
+        with torch.no_grad():
+            params1 = zip(*[gene1.parameters() for gene1, _ in pairs])
+            params2 = zip(*[gene2.parameters() for _, gene2 in pairs])
+            for group1, group2 in zip(params1, params2):
+                W1 = torch.stack(group1)
+                W2 = torch.stack(group2)
+                num_variables = W1.shape[1]
+                if len(W1.shape) == 3: #Weights no bias
+                    max_crossovers = num_variables * 2
+                elif len(W1.shape) == 2: #Bias
+                    max_crossovers = num_variables
+                else:
+                    continue
+                to_gene1, to_gene2 = self.crossover_masks(len(pairs), num_variables, max_crossovers)
+                to_gene1 = to_gene1.to(W1.device).view(to_gene1.shape + (1,) * (W1.dim() - 2))
+                to_gene2 = to_gene2.to(W1.device).view(to_gene2.shape + (1,) * (W1.dim() - 2))
+                new_W1 = torch.where(to_gene1, W2, W1)
+                new_W2 = torch.where(to_gene2, W1, W2)
+                for b, (param1, param2) in enumerate(zip(group1, group2)):
+                    param1.copy_(new_W1[b])
+                    param2.copy_(new_W2[b])
 
+    def crossover_inplace(self, gene1, gene2):
+        self.crossover_batch([(gene1, gene2)])
 
     def mutate_inplace(self, gene):
         mut_strength = 0.05
@@ -158,12 +191,19 @@ class SSNE:
         # Crossover for unselected genes with 100 percent probability
         if len(unselects) % 2 != 0:  # Number of unselects left should be even
             unselects.append(unselects[fastrand.pcg32bounded(len(unselects))])
+        # The crossovers are batched, a batch ends before a gene that it already contains is cloned again
+        pairs, crossed = [], set()
         for i, j in zip(unselects[0::2], unselects[1::2]):
+            if i in crossed or j in crossed:
+                self.crossover_batch(pairs)
+                pairs, crossed = [], set()
             off_i = random.choice(new_elitists);
             off_j = random.choice(offsprings)
             self.clone(master=pop[off_i], replacee=pop[i])
             self.clone(master=pop[off_j], replacee=pop[j])
-            self.crossover_inplace(pop[i], pop[j])
+            pairs.append((pop[i], pop[j]))
+            crossed.update((i, j))
+        self.crossover_batch(pairs)
 
         # unused
         # Crossover for selected offsprings
@@ -0,0 +1,383 @@
+"""
+Micro-benchmarks for the PDERL hot paths. They run on random data and do not need MuJoCo.
+
+    python benchmark.py -bench clone
+    python benchmark.py -bench per
+    python benchmark.py -bench memory
+    python benchmark.py -bench lockstep
+    python benchmark.py -bench numpy_policy
+    python benchmark.py -bench mutation
+    python benchmark.py -bench crossover
+    python benchmark.py -bench flat_population
+    python benchmark.py -bench proximal
+"""
+import argparse
+import math
+import random
+import tempfile
+import time
+import fastrand
+import numpy as np
+import torch
+
+from core import replay_memory
+from core.segment_tree import SumSegmentTree, MinSegmentTree
+from core.ddpg import Actor, hard_update, flat_parameters
+from core.population_eval import stack_actors, population_forward
+from core.population_store import PopulationStore
+from core.mod_neuro_evo import SSNE
+from core.mod_utils import is_lnorm_key
+from parameters import Parameters
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-bench', help='Benchmark to run', type=str, required=True)
+parser.add_argument('-state_dim', help='Observation size (Ant-v2 has 111)', type=int, default=111)
+parser.add_argument('-action_dim', help='Action size (Ant-v2 has 8)', type=int, default=8)
+parser.add_argument('-pop_size', help='Number of individuals in the population', type=int, default=10)
+parser.add_argument('-individual_bs', help='Size of the individual buffers', type=int, default=8000)
+parser.add_argument('-buffer_size', help='Size of the shared replay buffer', type=int, default=1000000)
+parser.add_argument('-batch_size', help='Minibatch size', type=int, default=128)
+parser.add_argument('-repeat', help='Number of timed repetitions', type=int, default=5)
+parser.add_argument('-seed', help='Random seed to be used', type=int, default=7)
+
+
+def timeit(fn, repeat):
+    """Returns the best wall time of fn over a number of repetitions"""
+    fn()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def random_transitions(num, args):
+    return (np.random.randn(num, args.state_dim), np.random.uniform(-1, 1, (num, args.action_dim)),
+            np.random.randn(num, args.state_dim), np.random.randn(num), np.zeros(num))
+
+
+def random_episodes(num, args, episode_length=1000):
+    """Transitions whose next state is the following state, except at the end of each episode"""
+    states = np.random.randn(num + 1, args.state_dim)
+    next_states = states[1:].copy()
+    ends = np.arange(episode_length - 1, num, episode_length)
+    next_states[ends] = np.random.randn(len(ends), args.state_dim)
+    dones = np.zeros(num)
+    dones[ends] = 1.0
+    return states[:-1], np.random.uniform(-1, 1, (num, args.action_dim)), next_states, np.random.randn(num), dones
+
+
+def fill(buffer, args):
+    # Write past the capacity so the copied range wraps around the end of the ring
+    buffer.extend(*random_transitions(buffer.capacity + buffer.capacity // 3, args))
+    return buffer
+
+
+def bench_clone(args):
+    """Cost of the buffer copies done by SSNE.clone for a whole generation"""
+    masters = [fill(replay_memory.ReplayMemory(args.individual_bs, 'cpu'), args) for _ in range(args.pop_size)]
+    replacees = [replay_memory.ReplayMemory(args.individual_bs, 'cpu') for _ in range(args.pop_size)]
+
+    def per_transition():
+        for master, replacee in zip(masters, replacees):
+            replacee.reset()
+            for transition in zip(*master.get_latest(replacee.capacity)):
+                replacee.add(*transition)
+
+    def bulk():
+        for master, replacee in zip(masters, replacees):
+            replacee.reset()
+            replacee.add_content_of(master)
+
+    before = timeit(per_transition, args.repeat)
+    after = timeit(bulk, args.repeat)
+    print('Clone of {} buffers with {} transitions per generation'.format(args.pop_size, args.individual_bs))
+    print('  per transition add: {:.2f} ms'.format(before * 1e3))
+    print('  bulk copy_from:     {:.2f} ms  ({:.0f}x)'.format(after * 1e3, before / after))
+
+
+def bench_per(args):
+    """One prioritised minibatch draw plus its priority update, linear scan against segment trees"""
+    alpha = 0.6
+    for capacity in (10 ** 5, 10 ** 6):
+        priorities = np.random.uniform(0.1, 2.0, capacity).astype(np.float32)
+        sum_tree, min_tree = SumSegmentTree(capacity), MinSegmentTree(capacity)
+        sum_tree.update(np.arange(capacity), priorities)
+        min_tree.update(np.arange(capacity), priorities)
+
+        def linear():
+            probs = priorities / priorities.sum()
+            indices = np.random.choice(capacity, args.batch_size, p=probs)
+            weights = (capacity * probs[indices]) ** -0.4 / (capacity * probs.min()) ** -0.4
+            for idx, prio in zip(indices, np.random.uniform(size=args.batch_size)):
+                priorities[idx] = (prio + 1e-5) ** alpha
+            return weights
+
+        def tree():
+            prio_sum = sum_tree.sum()
+            prefixsums = (np.arange(args.batch_size) + np.random.uniform(size=args.batch_size)) * \
+                         (prio_sum / args.batch_size)
+            indices = sum_tree.find_prefixsum_index(prefixsums)
+            weights = (capacity * sum_tree[indices] / prio_sum) ** -0.4 / \
+                      (capacity * min_tree.min() / prio_sum) ** -0.4
+            new_priorities = (np.random.uniform(size=args.batch_size) + 1e-5) ** alpha
+            sum_tree.update(indices, new_priorities)
+            min_tree.update(indices, new_priorities)
+            return weights
+
+        before = timeit(linear, args.repeat)
+        after = timeit(tree, args.repeat)
+        print('PER sample + update, capacity {}, batch {}'.format(capacity, args.batch_size))
+        print('  linear scan:   {:.3f} ms'.format(before * 1e3))
+        print('  segment trees: {:.3f} ms  ({:.0f}x)'.format(after * 1e3, before / after))
+
+
+def buffer_bytes(memory):
+    total = sum(field.nbytes for field in memory.storage if field is not None)
+    if isinstance(memory, replay_memory.DedupReplayMemory):
+        total += memory.last.nbytes + sum(obs.nbytes for obs in memory.final.values())
+    return total
+
+
+def bench_memory(args):
+    """Bytes taken by the shared buffer and the individual buffers for each storage layout"""
+    capacity = 20000
+    block = random_episodes(capacity, args)
+    for cls in (replay_memory.ReplayMemory, replay_memory.DedupReplayMemory):
+        for obs_dtype in (np.float32, np.float16):
+            memory = cls(capacity, 'cpu', obs_dtype)
+            memory.extend(*block)
+            per_transition = buffer_bytes(memory) / capacity
+            total = per_transition * (args.buffer_size + (args.pop_size + 1) * args.individual_bs)
+            print('{:>17} {:>8}: {:.0f} bytes per transition, {:.0f} MB for the shared and individual buffers'.format(
+                cls.__name__, np.dtype(obs_dtype).name, per_transition, total / 2 ** 20))
+
+
+def actor_args(args):
+    actor_args = Parameters(None, init=False)
+    actor_args.state_dim, actor_args.action_dim = args.state_dim, args.action_dim
+    actor_args.ls, actor_args.use_ln, actor_args.device = 128, True, torch.device('cpu')
+    return actor_args
+
+
+def bench_lockstep(args):
+    """
+    Action selection for one step of every running episode, one NumPy policy at a time as evaluate does
+    against one batched pass. The batched parameters are gathered once per set of running episodes.
+    """
+    actors = [Actor(actor_args(args)) for _ in range(args.pop_size)]
+    policies = [actor.numpy_policy() for actor in actors]
+    num_evals = 5
+    owners = np.repeat(np.arange(args.pop_size), num_evals)
+    states = np.random.randn(len(owners), args.state_dim).astype(np.float32)
+    stacked = stack_actors(actors)
+
+    def gather():
+        return {name: param[owners] for name, param in stacked.items()}
+    episode_params = gather()
+
+    def per_actor():
+        return np.concatenate([policies[owner].select_action(state) for owner, state in zip(owners, states)])
+
+    def batched():
+        with torch.no_grad():
+            return population_forward(episode_params, torch.from_numpy(states), True).numpy()
+
+    error = np.abs(per_actor().reshape(len(owners), -1) - batched()).max()
+    times = [float('inf')] * 3
+    for _ in range(args.repeat):
+        for i, fn in enumerate((per_actor, batched, gather)):
+            times[i] = min(times[i], timeit(fn, 1))
+    before, after, regather = times
+    print('Actions for {} episodes ({} actors x {} evaluations), max abs difference {:.1e}'.format(
+        len(owners), args.pop_size, num_evals, error))
+    print('  NumPy policies, one at a time: {:.3f} ms per step'.format(before * 1e3))
+    print('  batched forward:               {:.3f} ms per step  ({:.1f}x)'.format(after * 1e3, before / after))
+    print('  parameter gather:              {:.3f} ms, after episodes end'.format(regather * 1e3))
+
+
+def bench_numpy_policy(args):
+    """Per step action selection, torch forward against the NumPy snapshot, with a parity check"""
+    actor = Actor(actor_args(args))
+    policy = actor.numpy_policy()
+    states = np.random.randn(1000, args.state_dim)
+
+    error = max(np.abs(actor.select_action(state) - policy.select_action(state)).max() for state in states)
+    assert error < 1e-5, 'NumPy policy differs from the torch actor by {}'.format(error)
+
+    before = timeit(lambda: [actor.select_action(state) for state in states], args.repeat)
+    after = timeit(lambda: [policy.select_action(state) for state in states], args.repeat)
+    snapshot = timeit(actor.numpy_policy, args.repeat)
+    print('Action selection for {} states, max abs difference {:.1e}'.format(len(states), error))
+    print('  torch select_action: {:.2f} us per step'.format(before / len(states) * 1e6))
+    print('  NumPy policy:        {:.2f} us per step  ({:.1f}x)'.format(after / len(states) * 1e6, before / after))
+    print('  snapshot of the weights: {:.1f} us'.format(snapshot * 1e6))
+
+
+def ssne_args(args):
+    ssne_args = actor_args(args)
+    ssne_args.pop_size, ssne_args.elite_fraction, ssne_args.seed = args.pop_size, 0.2, args.seed
+    ssne_args.opstat, ssne_args.opstat_freq, ssne_args.save_foldername = False, 1, tempfile.mkdtemp()
+    return ssne_args
+
+
+def scalar_mutate(actor):
+    """The element by element SSNE.mutate_inplace, kept as the reference of the tensorized one"""
+    mut_strength, num_mutation_frac, super_mut_strength, super_mut_prob, reset_prob = 0.1, 0.1, 10, 0.05, 0.1
+    model_params = actor.state_dict()
+    ssne_probabilities = np.random.uniform(0, 1, len(model_params)) * 2
+    for i, key in enumerate(model_params):
+        W = model_params[key]
+        if is_lnorm_key(key) or len(W.shape) != 2:
+            continue
+        if random.random() < ssne_probabilities[i]:
+            num_mutations = fastrand.pcg32bounded(int(math.ceil(num_mutation_frac * W.numel())))
+            for _ in range(num_mutations):
+                ind_dim1 = fastrand.pcg32bounded(W.shape[0])
+                ind_dim2 = fastrand.pcg32bounded(W.shape[-1])
+                random_num = random.random()
+                if random_num < super_mut_prob:
+                    W[ind_dim1, ind_dim2] += random.gauss(0, super_mut_strength * W[ind_dim1, ind_dim2])
+                elif random_num < reset_prob:
+                    W[ind_dim1, ind_dim2] = random.gauss(0, 1)
+                else:
+                    W[ind_dim1, ind_dim2] += random.gauss(0, mut_strength * W[ind_dim1, ind_dim2])
+                W[ind_dim1, ind_dim2] = max(min(W[ind_dim1, ind_dim2], 1000000), -1000000)
+
+
+def bench_mutation(args):
+    """Tensorized mutate_inplace against the element by element loop, see tests/test_mutation.py for the statistics"""
+    ssne = SSNE(ssne_args(args), None, None)
+    agent = type('Gene', (), {})()
+    agent.actor = Actor(actor_args(args))
+
+    loop = timeit(lambda: scalar_mutate(agent.actor), args.repeat)
+    tensorized = timeit(lambda: ssne.mutate_inplace(agent), args.repeat)
+    print('mutate_inplace of one {}-{} actor'.format(128, 128))
+    print('  element loop: {:.2f} ms'.format(loop * 1e3))
+    print('  tensorized:   {:.2f} ms  ({:.0f}x)'.format(tensorized * 1e3, loop / tensorized))
+
+
+def scalar_crossover(actor1, actor2):
+    """The row by row SSNE.crossover_inplace, kept as the reference of the tensorized one"""
+    for param1, param2 in zip(actor1.parameters(), actor2.parameters()):
+        W1, W2 = param1.data, param2.data
+        num_cross_overs = fastrand.pcg32bounded(W1.shape[0] * (2 if len(W1.shape) == 2 else 1))
+        for _ in range(num_cross_overs):
+            receiver_choice = random.random()
+            ind_cr = fastrand.pcg32bounded(W1.shape[0])
+            if receiver_choice < 0.5:
+                W1[ind_cr] = W2[ind_cr]
+            else:
+                W2[ind_cr] = W1[ind_cr]
+
+
+def bench_crossover(args):
+    """Tensorized crossover_inplace and crossover_batch against the row by row loop, see tests/test_crossover.py"""
+    ssne = SSNE(ssne_args(args), None, None)
+    genes = []
+    for _ in range(args.pop_size - args.pop_size % 2):
+        gene = type('Gene', (), {})()
+        gene.actor = Actor(actor_args(args))
+        genes.append(gene)
+    pairs = list(zip(genes[0::2], genes[1::2]))
+
+    def loop(genes):
+        for gene1, gene2 in zip(genes[0::2], genes[1::2]):
+            scalar_crossover(gene1.actor, gene2.actor)
+
+    def single(genes):
+        for gene1, gene2 in zip(genes[0::2], genes[1::2]):
+            ssne.crossover_inplace(gene1, gene2)
+
+    def batched(genes):
+        ssne.crossover_batch(list(zip(genes[0::2], genes[1::2])))
+
+    times = [timeit(lambda: fn(genes), args.repeat) for fn in (loop, single, batched)]
+    print('Crossover of {} pairs of {}-{} actors'.format(len(pairs), 128, 128))
+    print('  row loop:          {:.2f} ms'.format(times[0] * 1e3))
+    print('  crossover_inplace: {:.2f} ms  ({:.0f}x)'.format(times[1] * 1e3, times[0] / times[1]))
+    print('  crossover_batch:   {:.2f} ms  ({:.0f}x)'.format(times[2] * 1e3, times[0] / times[2]))
+
+
+def bench_flat_population(args):
+    """Clone, flat parameter access and stacking of a population, tensor by tensor against a PopulationStore"""
+    loose = [Actor(actor_args(args)) for _ in range(args.pop_size)]
+    flat = [Actor(actor_args(args)) for _ in range(args.pop_size)]
+    for source, target in zip(loose, flat):
+        target.load_state_dict(source.state_dict())
+    store = PopulationStore(flat)
+    assert all(flat_parameters(actor) is not None for actor in flat) and flat_parameters(loose[0]) is None
+    for source, target in zip(loose, flat):
+        assert torch.equal(source(torch.ones(1, args.state_dim)), target(torch.ones(1, args.state_dim)))
+        assert torch.equal(source.extract_parameters(), target.extract_parameters())
+
+    pvec = torch.randn(loose[0].count_parameters())
+    for actors in (loose, flat):
+        actors[2].inject_parameters(pvec)
+        hard_update(actors[1], actors[2])
+    for key, value in loose[1].state_dict().items():
+        assert torch.equal(value, flat[1].state_dict()[key]), 'Different parameters after inject and clone'
+    stacked = stack_actors(flat)
+    for key, value in stack_actors(loose).items():
+        assert torch.equal(value, stacked[key]) and torch.equal(value, store.stacked()[key])
+
+    print('Population of {} actors with {} parameters each'.format(args.pop_size, store.weights.shape[1]))
+    for name, fn in (('hard_update', lambda actors: hard_update(actors[1], actors[0])),
+                     ('extract_parameters', lambda actors: actors[0].extract_parameters()),
+                     ('inject_parameters', lambda actors: actors[0].inject_parameters(pvec)),
+                     ('stack_actors', lambda actors: stack_actors(actors))):
+        before = timeit(lambda: fn(loose), args.repeat * 20)
+        after = timeit(lambda: fn(flat), args.repeat * 20)
+        print('  {:>18}: {:.1f} us -> {:.1f} us  ({:.1f}x)'.format(name, before * 1e6, after * 1e6, before / after))
+
+
+def bench_proximal(args):
+    """
+    Output sensitivity of proximal_mutate: backward per action against vmap over jacrev, one or all actors.
+    The repetitions of the three versions are interleaved so that a change of load on the machine hits all
+    of them, the parity is tested in tests/test_proximal.py
+    """
+    actors = [Actor(actor_args(args)) for _ in range(args.pop_size)]
+    states = [torch.randn(256, args.state_dim) for _ in actors]
+
+    def loop():
+        for actor, state in zip(actors, states):
+            SSNE.backward_sensitivity(actor, state)
+
+    def single():
+        for actor, state in zip(actors, states):
+            SSNE.output_sensitivity([actor], [state])
+
+    def batched():
+        SSNE.output_sensitivity(actors, states)
+
+    times = [float('inf')] * 3
+    for _ in range(args.repeat):
+        for i, fn in enumerate((loop, single, batched)):
+            times[i] = min(times[i], timeit(fn, 1))
+    print('Sensitivity of {} actors ({} states, {} actions, batch of 256), {} torch threads'.format(
+        len(actors), args.state_dim, args.action_dim, torch.get_num_threads()))
+    print('  backward per action: {:.1f} ms'.format(times[0] * 1e3))
+    print('  jacrev per actor:    {:.1f} ms  ({:.1f}x)'.format(times[1] * 1e3, times[0] / times[1]))
+    print('  vmap over actors:    {:.1f} ms  ({:.1f}x)'.format(times[2] * 1e3, times[0] / times[2]))
+
+BENCHMARKS = {
+    'clone': bench_clone,
+    'per': bench_per,
+    'memory': bench_memory,
+    'lockstep': bench_lockstep,
+    'numpy_policy': bench_numpy_policy,
+    'mutation': bench_mutation,
+    'crossover': bench_crossover,
+    'flat_population': bench_flat_population,
+    'proximal': bench_proximal,
+}
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    BENCHMARKS[args.bench](args)
@@ -0,0 +1,29 @@
+"""
+Converts champion buffers pickled by older runs (champion_buffer_*.pkl) into the .npz snapshot format.
+
+    python convert_buffer.py -source exp/run/models
+"""
+import argparse
+import glob
+import os
+
+from core import replay_memory
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-source', help='A .pkl buffer or a folder of them', type=str, required=True)
+parser.add_argument('-uncompressed', help='Write the arrays without compression', action='store_true')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if os.path.isdir(args.source):
+        # The folder also holds the actor and critic checkpoints, which are not buffers
+        sources = sorted(glob.glob(os.path.join(args.source, 'champion_buffer_*.pkl')))
+    else:
+        sources = [args.source]
+
+    for source in sources:
+        target = os.path.splitext(source)[0] + '.npz'
+        replay_memory.convert_legacy_buffer(source, target, compressed=not args.uncompressed)
+        print('{} -> {} ({:.1f} MB -> {:.1f} MB)'.format(source, target, os.path.getsize(source) / 2 ** 20,
+                                                          os.path.getsize(target) / 2 ** 20))
@@ -1,8 +1,20 @@
+import os
+import copy
+import threading
+import time
 import numpy as np
 from core import mod_neuro_evo as utils_ne
 from core import mod_utils as utils
 from core import replay_memory
 from core import ddpg as ddpg
+from core.prefetcher import BatchPrefetcher
+from core.population_eval import PopulationEvaluator
+from core.population_store import PopulationStore
+from core.rollout_workers import RolloutPool, episode_limit
+from core.racing import FitnessRace, protected_ranks
+from core.fitness_cache import FitnessCache
+from core.async_learner import AsyncLearner
+from core.eval_service import EvaluationService, flat_weights
 from scipy.spatial import distance
 from scipy.stats import rankdata
 from core import replay_memory
@@ -12,25 +24,58 @@ import torch
 
 
 class Agent:
-    def __init__(self, args: Parameters, env):
+    def __init__(self, args: Parameters, env, make_env=None):
         self.args = args; self.env = env
 
+        if args.per + args.memmap_buffer + args.torch_buffer + args.dedup_obs > 1:
+            raise NotImplementedError('Only one of -per, -memmap_buffer, -torch_buffer and -dedup_obs can be used')
+        if args.async_learner and (args.per or args.prefetch):
+            raise NotImplementedError('-async_learner cannot be used with -per or -prefetch')
+        if args.per:
+            self.replay_buffer = replay_memory.PrioritizedReplayMemory(args.buffer_size, args.device,
+                                                                       alpha=args.alpha, beta_start=args.beta_zero,
+                                                                       beta_frames=self.args.num_frames,
+                                                                       obs_dtype=args.obs_dtype)
+        elif args.memmap_buffer:
+            self.replay_buffer = replay_memory.MemmapReplayMemory(args.buffer_size, args.device,
+                                                                  os.path.join(args.save_foldername, 'replay_buffer'),
+                                                                  cache_budget=args.memmap_cache << 20,
+                                                                  obs_dtype=args.obs_dtype)
+        elif args.torch_buffer:
+            self.replay_buffer = replay_memory.TorchReplayMemory(args.buffer_size, args.device, args.obs_dtype)
+        elif args.dedup_obs:
+            self.replay_buffer = replay_memory.DedupReplayMemory(args.buffer_size, args.device, args.obs_dtype)
+        else:
+            self.replay_buffer = replay_memory.ReplayMemory(args.buffer_size, args.device, args.obs_dtype)
+        shared_buffer = self.replay_buffer if args.buffer_views else None
+
         # Init population
         self.pop = []
         self.buffers = []
         for _ in range(args.pop_size):
-            self.pop.append(ddpg.GeneticAgent(args))
+            self.pop.append(ddpg.GeneticAgent(args, shared_buffer))
 
         # Init RL Agent
-        self.rl_agent = ddpg.DDPG(args)
-        if args.per:
-            self.replay_buffer = replay_memory.PrioritizedReplayMemory(args.buffer_size, args.device,
-                                                                       beta_frames=self.args.num_frames)
-        else:
-            self.replay_buffer = replay_memory.ReplayMemory(args.buffer_size, args.device)
+        self.rl_agent = ddpg.DDPG(args, shared_buffer)
+
+        # Parameters of the population in one (pop_size, P) tensor, the RL actor in its own block
+        self.pop_store = None
+        if args.flat_population:
+            self.pop_store = PopulationStore([agent.actor for agent in self.pop])
+            self.rl_store = PopulationStore([self.rl_agent.actor])
 
         self.ounoise = ddpg.OUNoise(args.action_dim)
-        self.evolver = utils_ne.SSNE(self.args, self.rl_agent.critic, self.evaluate)
+        self.evolver = utils_ne.SSNE(self.args, self.rl_agent.critic, self.evaluate, self.evaluate_agents)
+
+        # Evaluation of the population on environment copies, in lockstep or in worker processes
+        if args.lockstep_eval and args.rollout_workers > 0:
+            raise NotImplementedError('Only one of -lockstep_eval and -rollout_workers can be used')
+        make_env = make_env or (lambda: copy.deepcopy(env))
+        self.pop_evaluator = None
+        if args.lockstep_eval:
+            self.pop_evaluator = PopulationEvaluator(args, make_env)
+        elif args.rollout_workers > 0:
+            self.pop_evaluator = RolloutPool(args, make_env, args.rollout_workers, args.pop_size, episode_limit(env))
 
         # Population novelty
         self.ns_r = 1.0
@@ -39,8 +84,28 @@ class Agent:
         self.time_since_improv = 0
         self.step = 1
 
+        # Test episodes in a separate process, started before the learner thread
+        self.eval_service = EvaluationService(args, make_env) if args.eval_service else None
+
+        # Racing fitness evaluation or fitness cache
+        if args.racing and args.fitness_cache:
+            raise NotImplementedError('Only one of -racing and -fitness_cache can be used')
+        if args.racing:
+            self.race = FitnessRace(args.num_evals, protected_ranks(args.pop_size, self.evolver.num_elitists),
+                                    z=args.race_z)
+        if args.fitness_cache:
+            self.fitness_cache = FitnessCache(args.num_evals, args.cache_fresh_evals)
+
+        # Transitions of the current episode, inserted in bulk at its end
+        self.staging = replay_memory.EpisodeStaging(args.staging_size)
+
         # Trackers
         self.num_games = 0; self.num_frames = 0; self.iterations = 0; self.gen_frames = None
+        self.prefetch_starved = 0; self.prefetch_full = 0
+
+        # DDPG learner thread, the lock guards the replay buffer and the RL networks it shares with the rollouts
+        self.lock = threading.Lock()
+        self.learner = AsyncLearner(self, self.lock) if args.async_learner else None
 
     def evaluate(self, agent: ddpg.GeneticAgent or ddpg.DDPG, is_render=False, is_action_noise=False,
                  store_transition=True, net_index=None):
@@ -49,11 +114,13 @@ class Agent:
 
         state = self.env.reset()
         done = False
+        # The weights do not change during an episode
+        policy = agent.actor.numpy_policy()
 
         while not done:
             if store_transition: self.num_frames += 1; self.gen_frames += 1
             if self.args.render and is_render: self.env.render()
-            action = agent.actor.select_action(np.array(state))
+            action = policy.select_action(state)
             if is_action_noise:
                 action += self.ounoise.noise()
                 action = np.clip(action, -1.0, 1.0)
@@ -62,25 +129,104 @@ class Agent:
             next_state, reward, done, info = self.env.step(action.flatten())
             total_reward += reward
 
-            transition = (state, action, next_state, reward, float(done))
             if store_transition:
-                self.replay_buffer.add(*transition)
-                agent.buffer.add(*transition)
+                self.staging.add(state, action, next_state, reward, float(done))
+                if self.staging.full():
+                    self.flush_staging(agent)
 
             state = next_state
-        if store_transition: self.num_games += 1
+        if store_transition:
+            self.flush_staging(agent)
+            self.num_games += 1
 
         return {'reward': total_reward, 'td_error': total_error}
 
+    def flush_staging(self, agent):
+        # The shared buffer is written first, individual buffer views reference its latest insertions
+        with self.lock:
+            self.staging.flush(self.replay_buffer, agent.buffer)
+        if self.learner is not None:
+            self.learner.notify()
+
+    def store_episodes(self, agents, episodes):
+        """
+        Stores in bulk the episodes returned by the population evaluator, with the same frame and game
+        accounting as evaluate
+        :param agents: the agents the episode indices refer to
+        :param episodes: the episodes returned by the population evaluator
+        """
+        with self.lock:
+            for episode in episodes:
+                transitions = episode['transitions']
+                self.replay_buffer.extend(*transitions)
+                agents[episode['index']].buffer.extend(*transitions)
+                self.num_frames += len(transitions.reward); self.gen_frames += len(transitions.reward)
+                self.num_games += 1
+        if self.learner is not None:
+            self.learner.notify()
+
+    def evaluate_population(self):
+        """
+        Plays num_evals episodes with every individual on the population evaluator
+        :return: the summed rewards and td errors of each individual
+        """
+        rewards = np.zeros(len(self.pop))
+        errors = np.zeros(len(self.pop))
+        episodes = self.pop_evaluator.evaluate(self.pop, self.args.num_evals)
+        self.store_episodes(self.pop, episodes)
+        for episode in episodes:
+            rewards[episode['index']] += episode['reward']
+        return rewards, errors
+
+    def play_population(self, indices):
+        """
+        Plays one episode with each of the given individuals
+        :param indices: the indices of the individuals in the population
+        :return: the reward and the length of each episode
+        """
+        agents = [self.pop[i] for i in indices]
+        if self.pop_evaluator is not None:
+            episodes = self.pop_evaluator.evaluate(agents, 1)
+            self.store_episodes(agents, episodes)
+            return [episode['reward'] for episode in episodes], [len(episode['transitions'].reward) for episode in episodes]
+        rewards, lengths = [], []
+        for agent in agents:
+            frames = self.num_frames
+            rewards.append(self.evaluate(agent, is_render=False, is_action_noise=False)['reward'])
+            lengths.append(self.num_frames - frames)
+        return rewards, lengths
+
+    def evaluate_agents(self, agents, num_evals):
+        """
+        Mean reward of each agent over num_evals episodes that are not stored, played in one batch on the
+        population evaluator when there is one
+        """
+        if self.pop_evaluator is not None:
+            rewards = np.zeros(len(agents))
+            for episode in self.pop_evaluator.evaluate(agents, num_evals, store_transition=False):
+                rewards[episode['index']] += episode['reward']
+            return rewards / num_evals
+        return np.array([np.mean([self.evaluate(agent, store_transition=False)['reward'] for _ in range(num_evals)])
+                         for agent in agents])
+
+    def test_score(self, agent: ddpg.GeneticAgent or ddpg.DDPG, num_evals=5):
+        """Mean reward of agent over num_evals episodes that are not stored"""
+        if self.pop_evaluator is not None:
+            episodes = self.pop_evaluator.evaluate([agent], num_evals, store_transition=False)
+            return np.mean([episode['reward'] for episode in episodes])
+        score = 0
+        for _ in range(num_evals):
+            episode = self.evaluate(agent, is_render=True, is_action_noise=False, store_transition=False)
+            score += episode['reward']
+        return score / num_evals
+
     def rl_to_evo(self, rl_agent: ddpg.DDPG, evo_net: ddpg.GeneticAgent):
-        for target_param, param in zip(evo_net.actor.parameters(), rl_agent.actor.parameters()):
-            target_param.data.copy_(param.data)
+        ddpg.hard_update(evo_net.actor, rl_agent.actor)
         evo_net.buffer.reset()
         evo_net.buffer.add_content_of(rl_agent.buffer)
 
     def evo_to_rl(self, rl_net, evo_net):
-        for target_param, param in zip(rl_net.parameters(), evo_net.parameters()):
-            target_param.data.copy_(param.data)
+        ddpg.hard_update(rl_net, evo_net)
 
     def get_pop_novelty(self):
         epochs = self.args.ns_epochs
@@ -96,11 +242,32 @@ class Agent:
     def train_ddpg(self):
         bcs_loss, pgs_loss = [], []
         if len(self.replay_buffer) > self.args.batch_size * 5:
-            for _ in range(int(self.gen_frames * self.args.frac_frames_train)):
-                batch = self.replay_buffer.sample(self.args.batch_size)
-
-                pgl, delta = self.rl_agent.update_parameters(batch)
-                pgs_loss.append(pgl)
+            num_updates = int(self.gen_frames * self.args.frac_frames_train)
+            if self.args.per:
+                # Priorities change after every update so each minibatch is drawn on its own
+                for _ in range(num_updates):
+                    batch, indices, weights = self.replay_buffer.sample(self.args.batch_size)
+                    pgl, delta = self.rl_agent.update_parameters(batch, weights)
+                    self.replay_buffer.update_priorities(indices, delta.cpu().numpy())
+                    pgs_loss.append(pgl)
+            elif self.args.prefetch:
+                # The seed comes from the global generator so that runs stay reproducible
+                with BatchPrefetcher(self.replay_buffer, num_updates, self.args.batch_size,
+                                     seed=np.random.randint(2**31), queue_size=self.args.prefetch_queue,
+                                     batches_per_draw=self.args.batches_per_draw) as prefetcher:
+                    for _ in range(num_updates):
+                        pgl, delta = self.rl_agent.update_parameters(prefetcher.get())
+                        pgs_loss.append(pgl)
+                self.prefetch_starved += prefetcher.starved
+                self.prefetch_full += prefetcher.full
+            else:
+                # The buffer does not change while training, so the minibatches are drawn in large blocks
+                for start in range(0, num_updates, self.args.batches_per_draw):
+                    num_batches = min(self.args.batches_per_draw, num_updates - start)
+                    batches = self.replay_buffer.sample_many(num_batches, self.args.batch_size)
+                    for batch in zip(*batches):
+                        pgl, delta = self.rl_agent.update_parameters(batch)
+                        pgs_loss.append(pgl)
 
         return {'bcs_loss': 0, 'pgs_loss': pgs_loss}
 
@@ -110,16 +277,28 @@ class Agent:
 
         # ========================== EVOLUTION  ==========================
         # Evaluate genomes/individuals
-        rewards = np.zeros(len(self.pop))
-        errors = np.zeros(len(self.pop))
-        for i, net in enumerate(self.pop):
-            for _ in range(self.args.num_evals):
-                episode = self.evaluate(net, is_render=False, is_action_noise=False, net_index=i)
-                rewards[i] += episode['reward']
-                errors[i] += episode['td_error']
-
-        rewards /= self.args.num_evals
-        errors /= self.args.num_evals
+        if self.args.racing:
+            # Mean rewards over the episodes each individual played before being dropped
+            rewards = self.race.run(self.play_population, len(self.pop))
+            errors = np.zeros(len(self.pop))
+        elif self.args.fitness_cache:
+            # Running mean rewards, individuals with cached weights only play a few fresh episodes
+            rewards = self.fitness_cache.run(self.play_population, self.pop)
+            errors = np.zeros(len(self.pop))
+        else:
+            if self.pop_evaluator is not None:
+                rewards, errors = self.evaluate_population()
+            else:
+                rewards = np.zeros(len(self.pop))
+                errors = np.zeros(len(self.pop))
+                for i, net in enumerate(self.pop):
+                    for _ in range(self.args.num_evals):
+                        episode = self.evaluate(net, is_render=False, is_action_noise=False, net_index=i)
+                        rewards[i] += episode['reward']
+                        errors[i] += episode['td_error']
+
+            rewards /= self.args.num_evals
+            errors /= self.args.num_evals
 
         # all_fitness = 0.8 * rankdata(rewards) + 0.2 * rankdata(errors)
         all_fitness = rewards
@@ -130,27 +309,45 @@ class Agent:
 
         # print("Best TD Error:", np.max(errors))
 
-        test_score = 0
-        for eval in range(5):
-            episode = self.evaluate(champion, is_render=True, is_action_noise=False, store_transition=False)
-            test_score += episode['reward']
-        test_score /= 5.0
+        # Test episodes every test_every generations, in the evaluation service if there is one
+        test_due = self.iterations % self.args.test_every == 0
+        test_score = None
+        if test_due and self.eval_service is not None:
+            champion_weights = flat_weights(champion.actor)  # Before the operators change it
+        elif test_due:
+            test_score = self.test_score(champion)
 
         # NeuroEvolution's probabilistic selection and recombination step
-        elite_index = self.evolver.epoch(self.pop, all_fitness)
+        # The critic used by the operators is also trained by the learner thread
+        with self.lock:
+            elite_index = self.evolver.epoch(self.pop, all_fitness)
 
         # ========================== DDPG ===========================
+        # With the learner thread the rollouts use the actor it last published. The learner overlaps with at
+        # most one generation of rollouts and has to be done with the frames of the previous ones.
+        if self.learner is not None:
+            self.learner.wait(max_lag=int(self.gen_frames * self.args.frac_frames_train))
+            rl_agent = self.learner.snapshot()
+        else:
+            rl_agent = self.rl_agent
+
         # Collect experience for training
-        self.evaluate(self.rl_agent, is_action_noise=True)
+        self.evaluate(rl_agent, is_action_noise=True)
 
-        losses = self.train_ddpg()
+        if self.learner is not None:
+            self.learner.end_generation(self.gen_frames)
+            losses = {'bcs_loss': 0, 'pgs_loss': self.learner.pop_losses()}
+        else:
+            losses = self.train_ddpg()
 
         # Validation test for RL agent
-        testr = 0
-        for eval in range(5):
-            ddpg_stats = self.evaluate(self.rl_agent, store_transition=False, is_action_noise=False)
-            testr += ddpg_stats['reward']
-        testr /= 5
+        testr = None
+        if test_due and self.eval_service is not None:
+            self.eval_service.submit({'test_score': champion_weights, 'ddpg_reward': flat_weights(rl_agent.actor)},
+                                     generation=self.iterations, frames=self.num_frames, games=self.num_games,
+                                     time=time.time())
+        elif test_due:
+            testr = self.test_score(rl_agent)
 
         # Sync RL Agent to NE every few steps
         if self.iterations % self.args.rl_to_ea_synch_period == 0:
@@ -159,7 +356,7 @@ class Agent:
             if replace_index == elite_index:
                 replace_index = (replace_index + 1) % len(self.pop)
 
-            self.rl_to_evo(self.rl_agent, self.pop[replace_index])
+            self.rl_to_evo(rl_agent, self.pop[replace_index])
             self.evolver.rl_policy = replace_index
             print('Sync from RL --> Nevo')
 
@@ -169,9 +366,12 @@ class Agent:
             'test_score': test_score,
             'elite_index': elite_index,
             'ddpg_reward': testr,
-            'pg_loss': np.mean(losses['pgs_loss']),
+            'pg_loss': utils.mean_loss(losses['pgs_loss']),
             'bc_loss': np.mean(losses['bcs_loss']),
             'pop_novelty': np.mean(0),
+            'race_frames_saved': self.race.frames_saved if self.args.racing else 0,
+            'cache_frames_saved': self.fitness_cache.frames_saved if self.args.fitness_cache else 0,
+            'test_results': self.eval_service.poll() if self.eval_service is not None else [],
         }
 
 
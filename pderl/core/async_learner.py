@@ -0,0 +1,116 @@
+import copy
+import threading
+import numpy as np
+from core.ddpg import hard_update
+
+
+class PolicySnapshot:
+    """A copy of the actor of the RL agent, used by the rollouts while the learner keeps training"""
+
+    def __init__(self, rl_agent):
+        self.actor = copy.deepcopy(rl_agent.actor)
+        self.buffer = rl_agent.buffer
+
+
+class AsyncLearner:
+    """
+    Runs the DDPG updates in a background thread while the main thread plays the population and exploration
+    episodes. The number of gradient steps is capped by the update to data ratio: after n frames have been
+    stored, at most frac_frames_train * n updates are done. Agent.train waits for the learner to be at most
+    one generation of frames behind, so a run makes the same number of updates as the sequential train_ddpg.
+
+    As in train_ddpg, the frames only start to count with the first generation that ends with more than
+    batch_size * 5 transitions in the replay buffer, see end_generation.
+
+    The replay buffer, the critic and the actor are shared with the main thread, which holds lock while
+    writing to the buffer or reading the networks. The learner holds it for each sampling and each update.
+    """
+
+    def __init__(self, agent, lock):
+        self.agent = agent
+        self.args = agent.args
+        self.lock = lock
+        self.updates = 0
+        self.start_frame = None  # First frame counted by the budget, set at the end of the warm-up
+        self.losses = []
+        self.error = None
+        self.snapshot_agent = PolicySnapshot(agent.rl_agent)
+        # Own generator so that the draws of the two threads do not interleave on the global one
+        self.rng = np.random.RandomState(np.random.randint(2**31))
+        self.data_event = threading.Event()
+        self.progress_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def budget(self):
+        """Number of updates allowed by the frames stored so far"""
+        if self.start_frame is None:
+            return 0
+        return int((self.agent.num_frames - self.start_frame) * self.args.frac_frames_train) - self.updates
+
+    def end_generation(self, gen_frames):
+        """
+        Called by the main thread after the last rollout of a generation, where train_ddpg would run
+        :param gen_frames: the number of frames of the generation
+        """
+        if self.start_frame is None and len(self.agent.replay_buffer) > self.args.batch_size * 5:
+            # train_ddpg trains on all the frames of the generation that ends the warm-up
+            self.start_frame = self.agent.num_frames - gen_frames
+            self.notify()
+
+    def notify(self):
+        """Called by the main thread after storing new transitions"""
+        self.data_event.set()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                num_batches = min(self.budget(), self.args.batches_per_draw)
+                if num_batches <= 0:
+                    self.data_event.wait(0.1)
+                    self.data_event.clear()
+                    continue
+                with self.lock:
+                    batches = self.agent.replay_buffer.sample_many(num_batches, self.args.batch_size, rng=self.rng)
+                for batch in zip(*batches):
+                    with self.lock:
+                        pgl, delta = self.agent.rl_agent.update_parameters(batch)
+                        self.losses.append(pgl)
+                        self.updates += 1
+                self.progress_event.set()
+        except Exception as e:
+            # Raised in the main thread by the next call to pop_losses or snapshot
+            self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def wait(self, max_lag=0):
+        """Blocks until at most max_lag of the allowed updates are still to be done"""
+        while self.budget() > max_lag:
+            self._check()
+            self.progress_event.wait(0.1)
+            self.progress_event.clear()
+        self._check()
+
+    def pop_losses(self):
+        """Returns the policy losses of the updates done since the last call"""
+        self._check()
+        with self.lock:
+            losses, self.losses = self.losses, []
+        return losses
+
+    def snapshot(self):
+        """Publishes the current actor of the learner and returns it with the buffer of the RL agent"""
+        self._check()
+        with self.lock:
+            hard_update(self.snapshot_agent.actor, self.agent.rl_agent.actor)
+        return self.snapshot_agent
+
+    def close(self, drain=True):
+        if drain:
+            self.wait()
+        self.stop_event.set()
+        self.thread.join()
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 from torch.optim import Adam
@@ -14,19 +15,70 @@ def soft_update(target, source, tau):
 
 
 def hard_update(target, source):
+    target_flat, source_flat = flat_parameters(target), flat_parameters(source)
+    if target_flat is not None and source_flat is not None and target_flat.shape == source_flat.shape:
+        target_flat.copy_(source_flat)
+        return
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
 
 
+def flat_layout(module):
+    """Order of the parameters in a flat block: the weight matrices first, as in extract_parameters, then the rest"""
+    # Cached on the module, the Parameter objects do not change when their data is moved
+    if '_flat_layout' not in module.__dict__:
+        named = list(module.named_parameters())
+        weights = [(name, param) for name, param in named if not is_lnorm_key(name) and len(param.shape) == 2]
+        others = [(name, param) for name, param in named if is_lnorm_key(name) or len(param.shape) != 2]
+        module._flat_layout = weights + others
+    return module._flat_layout
+
+
+def _storage_size(tensor):
+    # Number of elements of the storage of a tensor, untyped_storage replaces storage from torch 2.0
+    if hasattr(tensor, 'untyped_storage'):
+        return tensor.untyped_storage().nbytes() // tensor.element_size()
+    return tensor.storage().size()
+
+
+def flat_parameters(module):
+    """
+    The parameters of a module as a single flat view, if they are laid out one after the other in flat_layout
+    order in the same storage (see PopulationStore), None otherwise
+    """
+    params = [param.data for _, param in flat_layout(module)]
+    first = params[0]
+    address, size = first.data_ptr(), 0
+    for param in params:
+        if param.dtype != first.dtype or param.device != first.device or not param.is_contiguous() or \
+                param.data_ptr() != address + size * first.element_size():
+            return None
+        size += param.numel()
+    # Memory that only happens to follow the first parameter is not part of its storage
+    if first.storage_offset() + size > _storage_size(first):
+        return None
+    return torch.as_strided(first, (size,), (1,), first.storage_offset())
+
+
+def individual_buffer(args: Parameters, shared_buffer=None):
+    # With a shared buffer the individual only keeps references to the transitions stored there
+    if shared_buffer is not None:
+        return replay_memory.ReplayView(shared_buffer, args.individual_bs)
+    if args.dedup_obs:
+        return replay_memory.DedupReplayMemory(args.individual_bs, args.device, args.obs_dtype)
+    return replay_memory.ReplayMemory(args.individual_bs, args.device, args.obs_dtype)
+
+
 class GeneticAgent:
-    def __init__(self, args: Parameters):
+    def __init__(self, args: Parameters, shared_buffer=None):
 
         self.args = args
 
         self.actor = Actor(args)
         self.actor_optim = Adam(self.actor.parameters(), lr=1e-3)
 
-        self.buffer = replay_memory.ReplayMemory(self.args.individual_bs, args.device)
+        self.shared_buffer = shared_buffer
+        self.buffer = individual_buffer(args, shared_buffer)
         self.loss = nn.MSELoss()
 
     def update_parameters(self, batch, p1, p2, critic):
@@ -94,6 +146,10 @@ class Actor(nn.Module):
         state = torch.FloatTensor(state.reshape(1, -1)).to(self.args.device)
         return self.forward(state).cpu().data.numpy().flatten()
 
+    def numpy_policy(self):
+        # Snapshot of the current weights, take a new one after the weights change
+        return NumpyActor(self)
+
     def get_novelty(self, batch):
         state_batch, action_batch, _, _, _ = batch
         novelty = torch.mean(torch.sum((action_batch - self.forward(state_batch))**2, dim=-1))
@@ -115,6 +171,9 @@ class Actor(nn.Module):
     # function to grab current flattened neural network weights
     def extract_parameters(self):
         tot_size = self.count_parameters()
+        flat = flat_parameters(self)
+        if flat is not None:  # The weight matrices are the start of the flat block
+            return flat[:tot_size].clone()
         pvec = torch.zeros(tot_size, dtype=torch.float32).to(self.args.device)
         count = 0
         for name, param in self.named_parameters():
@@ -127,6 +186,10 @@ class Actor(nn.Module):
 
     # function to inject a flat vector of ANN parameters into the model's current neural network weights
     def inject_parameters(self, pvec):
+        flat = flat_parameters(self)
+        if flat is not None:
+            flat[:self.count_parameters()].copy_(pvec.data)
+            return
         count = 0
         for name, param in self.named_parameters():
             if is_lnorm_key(name) or len(param.shape) != 2:
@@ -189,10 +252,10 @@ class Critic(nn.Module):
 
 
 class DDPG(object):
-    def __init__(self, args):
+    def __init__(self, args, shared_buffer=None):
 
         self.args = args
-        self.buffer = replay_memory.ReplayMemory(args.individual_bs, args.device)
+        self.buffer = individual_buffer(args, shared_buffer)
 
         self.actor = Actor(args, init=True)
         self.actor_target = Actor(args, init=True)
@@ -220,19 +283,15 @@ class DDPG(object):
         dt = (current_q - target_q).abs()
         return dt.item()
 
-    def update_parameters(self, batch):
+    def update_parameters(self, batch, weights=None):
+        """
+        Runs one critic and actor update
+        :param batch: the (state, action, next_state, reward, done) tensors
+        :param weights: optional per sample importance sampling weights for prioritised replay
+        :return: the policy gradient loss and the per sample absolute TD errors, as tensors left on the device
+        """
         state_batch, action_batch, next_state_batch, reward_batch, done_batch = batch
 
-        # Load everything to GPU if not already
-        self.actor_target.to(self.args.device)
-        self.critic_target.to(self.args.device)
-        self.critic.to(self.args.device)
-        state_batch = state_batch.to(self.args.device)
-        next_state_batch = next_state_batch.to(self.args.device)
-        action_batch = action_batch.to(self.args.device)
-        reward_batch = reward_batch.to(self.args.device)
-        if self.args.use_done_mask: done_batch = done_batch.to(self.args.device)
-
         # Critic Update
         next_action_batch = self.actor_target.forward(next_state_batch)
         next_q = self.critic_target.forward(next_state_batch, next_action_batch)
@@ -242,7 +301,10 @@ class DDPG(object):
         self.critic_optim.zero_grad()
         current_q = self.critic.forward(state_batch, action_batch)
         delta = (current_q - target_q).abs()
-        dt = torch.mean(delta**2)
+        if weights is None:
+            dt = torch.mean(delta**2)
+        else:
+            dt = torch.mean(weights.view(-1, 1) * delta**2)
         dt.backward()
         nn.utils.clip_grad_norm_(self.critic.parameters(), 10)
         self.critic_optim.step()
@@ -260,7 +322,7 @@ class DDPG(object):
         soft_update(self.actor_target, self.actor, self.tau)
         soft_update(self.critic_target, self.critic, self.tau)
 
-        return policy_grad_loss.data.cpu().numpy(), delta.data.cpu().numpy()
+        return policy_grad_loss.detach(), delta.detach()
 
 
 def fanin_init(size, fanin=None):
@@ -269,6 +331,32 @@ def fanin_init(size, fanin=None):
 
 def actfn_none(inp): return inp
 
+class NumpyActor:
+    """
+    Inference only copy of an Actor, with its weights as contiguous NumPy arrays and a NumPy forward pass.
+    It avoids the tensor creation, autograd and device transfer of Actor.select_action at every step.
+    """
+
+    def __init__(self, actor: Actor):
+        with torch.no_grad():
+            self.layers = [(np.ascontiguousarray(layer.weight.cpu().numpy().T), layer.bias.cpu().numpy().copy())
+                           for layer in (actor.w_l1, actor.w_l2, actor.w_out)]
+            self.norms = [(norm.gamma.cpu().numpy().copy(), norm.beta.cpu().numpy().copy(), norm.eps)
+                          for norm in (actor.lnorm1, actor.lnorm2)] if actor.args.use_ln else None
+
+    def select_action(self, state):
+        out = np.asarray(state, dtype=np.float32).reshape(-1)
+        for i, (weight, bias) in enumerate(self.layers):
+            out = out @ weight + bias
+            if self.norms is not None and i < len(self.norms):
+                gamma, beta, eps = self.norms[i]
+                # Same as LayerNorm, which uses the unbiased standard deviation
+                centered = out - out.sum() / out.size
+                out = centered * (gamma / (math.sqrt(centered @ centered / (out.size - 1)) + eps)) + beta
+            np.tanh(out, out=out)
+        return out
+
+
 class LayerNorm(nn.Module):
 
     def __init__(self, features, eps=1e-6):
@@ -0,0 +1,89 @@
+import copy
+import multiprocessing as mp
+import queue
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from core.ddpg import Actor
+
+
+def flat_weights(actor):
+    """Snapshot of all the parameters of an actor as a flat NumPy vector"""
+    with torch.no_grad():
+        return parameters_to_vector(actor.parameters()).cpu().numpy().copy()
+
+
+def _evaluation_worker(args, make_env, num_episodes, jobs, results):
+    torch.set_num_threads(1)
+    env = make_env()
+    env.seed(args.seed)
+    actor = Actor(args)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        result = dict(job['info'])
+        try:
+            for name, weights in job['weights'].items():
+                vector_to_parameters(torch.from_numpy(weights), actor.parameters())
+                policy = actor.numpy_policy()
+                total_reward = 0.0
+                for _ in range(num_episodes):
+                    state = env.reset()
+                    done = False
+                    while not done:
+                        state, reward, done, info = env.step(policy.select_action(state).flatten())
+                        total_reward += reward
+                result[name] = total_reward / num_episodes
+        except Exception as e:
+            result = e
+        results.put(result)
+
+
+class EvaluationService:
+    """
+    Plays the noise-free test episodes in a separate process with its own environment, off the critical
+    path of training. A job is a set of named weight snapshots plus the counters of the moment they were
+    taken (frames, games, ...), and its result holds the same counters and the mean reward of each snapshot.
+    """
+
+    def __init__(self, args, make_env, num_episodes=5):
+        self.worker_args = copy.copy(args)
+        self.worker_args.device = torch.device('cpu')
+        self.pending = 0
+        context = mp.get_context('fork')
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.worker = context.Process(target=_evaluation_worker, daemon=True,
+                                      args=(self.worker_args, make_env, num_episodes, self.jobs, self.results))
+        self.worker.start()
+
+    def submit(self, weights, **info):
+        """
+        Queues the test episodes of a set of snapshots
+        :param weights: dict from result name to the flat weights of an actor (see flat_weights)
+        :param info: counters returned with the result
+        """
+        self.jobs.put({'weights': weights, 'info': info})
+        self.pending += 1
+
+    def poll(self, block=False):
+        """Returns the results of the finished jobs, or of all the submitted jobs if block is set"""
+        finished = []
+        while self.pending > 0:
+            try:
+                result = self.results.get(block=block)
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if isinstance(result, Exception):
+                raise result
+            finished.append(result)
+        return finished
+
+    def close(self):
+        """Waits for the submitted jobs, stops the worker and returns the last results"""
+        finished = self.poll(block=True)
+        self.jobs.put(None)
+        self.worker.join()
+        return finished
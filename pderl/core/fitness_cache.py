@@ -0,0 +1,55 @@
+import hashlib
+import numpy as np
+import torch
+from torch.nn.utils import parameters_to_vector
+
+
+def fingerprint(actor):
+    """Hash of the flat parameters of an actor, equal for actors with bit identical weights"""
+    with torch.no_grad():
+        params = parameters_to_vector(actor.parameters()).cpu().numpy()
+    return hashlib.blake2b(params.tobytes(), digest_size=16).digest()
+
+
+class FitnessCache:
+    """
+    Episode returns of the individuals, keyed by the fingerprint of their weights. An individual whose
+    weights are in the cache (e.g. an elite spared by SSNE.epoch) only plays fresh_evals new episodes and
+    its fitness is the running mean over all its episodes, the others play num_evals episodes.
+
+    Entries whose weights are no longer in the population are evicted after every generation.
+    """
+
+    def __init__(self, num_evals, fresh_evals):
+        self.num_evals = num_evals
+        self.fresh_evals = fresh_evals
+        self.entries = {}  # fingerprint -> [sum of returns, number of episodes, sum of episode lengths]
+        self.frames_saved = 0
+
+    def run(self, play, agents):
+        """
+        Evaluates the agents
+        :param play: function playing one episode with each of the given agent indices and returning
+        their rewards and lengths
+        :param agents: the agents to evaluate
+        :return: the running mean return of each agent
+        """
+        keys = [fingerprint(agent.actor) for agent in agents]
+        hits = [key in self.entries for key in keys]
+        needed = np.array([self.fresh_evals if hit else self.num_evals for hit in hits])
+
+        # Episodes skipped thanks to the cache, counted at the mean length of the cached episodes
+        self.frames_saved = sum((self.num_evals - self.fresh_evals) * self.entries[key][2] / self.entries[key][1]
+                                for key, hit in zip(keys, hits) if hit)
+
+        entries = {key: list(self.entries.get(key, [0.0, 0, 0])) for key in keys}
+        for episode in range(needed.max(initial=0)):
+            indices = np.flatnonzero(needed > episode)
+            rewards, lengths = play(indices)
+            for i, reward, length in zip(indices, rewards, lengths):
+                entry = entries[keys[i]]
+                entry[0] += reward; entry[1] += 1; entry[2] += length
+
+        # Only the weights still in the population are kept
+        self.entries = entries
+        return np.array([entries[key][0] / entries[key][1] for key in keys])
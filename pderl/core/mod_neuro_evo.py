@@ -1,6 +1,6 @@
 import random
 import numpy as np
-from core.ddpg import GeneticAgent, hard_update
+from core.ddpg import GeneticAgent, Actor, hard_update, flat_layout
 from typing import List
 from core import replay_memory
 import fastrand, math
@@ -9,17 +9,26 @@ import torch.distributions as dist
 from core.mod_utils import is_lnorm_key
 from parameters import Parameters
 import os
+from core.fitness_cache import fingerprint
+from core.population_eval import stack_actors
 
 
 class SSNE:
-    def __init__(self, args: Parameters, critic, evaluate):
+    def __init__(self, args: Parameters, critic, evaluate, evaluate_many=None):
         self.current_gen = 0
         self.args = args;
         self.critic = critic
         self.population_size = self.args.pop_size
         self.num_elitists = int(self.args.elite_fraction * args.pop_size)
         self.evaluate = evaluate
+        self.evaluate_many = evaluate_many
         self.stats = PopulationStats(self.args)
+        self.opstat_trials = 5
+        self.generator = torch.Generator(device=args.device)  # Random stream of the tensorized operators
+        self.generator.manual_seed(args.seed)
+        self.known_fitness = {}  # Fitness of the weights evaluated this generation, keyed by fingerprint
+        self.opstat_snapshots = []  # Actors waiting for the batched operator statistics evaluation
+        self.opstat_records = []
         if self.num_elitists < 1: self.num_elitists = 1
 
         self.rl_policy = None
@@ -45,84 +54,86 @@ class SSNE:
         if weight < -mag: weight = -mag
         return weight
 
-    def crossover_inplace(self, gene1: GeneticAgent, gene2: GeneticAgent):
-        # Evaluate the parents
-        trials = 5
+    def crossover_masks(self, batch, num_rows, max_crossovers):
+        """
+        Draws the row swaps of a batch of crossovers between tensors with num_rows rows. Each crossover makes
+        a number of swaps uniform in [0, max_crossovers), each one copying a random row from one parent to the
+        other. Once a row has been copied the two parents hold the same values, so later swaps of that row
+        change nothing and the result of the sequential swaps only depends on the first swap of each row.
+        :return: two (batch, num_rows) masks, the rows gene1 takes from gene2 and the rows gene2 takes from gene1
+        """
+        options = dict(generator=self.generator, device=self.args.device)
+        num_cross_overs = torch.randint(max_crossovers, (batch, 1), **options)  # Lower bounded on full swaps
+        rows = torch.randint(num_rows, (batch, max_crossovers), **options)
+        to_gene1 = torch.rand(batch, max_crossovers, **options) < 0.5  # Choose which gene receives the row
+
+        # Swaps sorted by row and then by position, the first swap of a row starts its run. The swaps after
+        # num_cross_overs go to the extra row num_rows, which is dropped
+        positions = torch.arange(max_crossovers, device=self.args.device).expand(batch, max_crossovers)
+        rows = torch.where(positions < num_cross_overs, rows, torch.full_like(rows, num_rows))
+        order = rows * max_crossovers + positions
+        perm = order.sort(1)[1]
+        sorted_rows = rows.gather(1, perm)
+        first = torch.ones_like(sorted_rows, dtype=torch.bool)
+        first[:, 1:] = sorted_rows[:, 1:] != sorted_rows[:, :-1]
+        first_to_gene1 = to_gene1.gather(1, perm)
+
+        # Only the first swap of each row writes to it, the others write to the dropped row
+        target = torch.where(first, sorted_rows, torch.full_like(sorted_rows, num_rows))
+        masks = torch.zeros(2, batch, num_rows + 1, dtype=torch.bool, device=self.args.device)
+        masks[0].scatter_(1, target, first & first_to_gene1)
+        masks[1].scatter_(1, target, first & ~first_to_gene1)
+        return masks[0, :, :num_rows], masks[1, :, :num_rows]
+
+    def crossover_batch(self, pairs):
+        """
+        Row crossover between the two genes of each pair, all the pairs at once
+        :param pairs: list of (gene1, gene2), a gene can only appear once
+        """
+        if len(pairs) == 0:
+            return
+        # Scores of the parents
         if self.args.opstat and self.stats.should_log():
-            test_score_p1 = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene1, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_p1 += episode['reward']
-            test_score_p1 /= trials
-
-            test_score_p2 = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene2, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_p2 += episode['reward']
-            test_score_p2 /= trials
-
-        for param1, param2 in zip(gene1.actor.parameters(), gene2.actor.parameters()):
-            # References to the variable tensors
-            W1 = param1.data
-            W2 = param2.data
-
-            if len(W1.shape) == 2: #Weights no bias
-                num_variables = W1.shape[0]
-                # Crossover opertation [Indexed by row]
-                num_cross_overs = fastrand.pcg32bounded(num_variables * 2)  # Lower bounded on full swaps
-                for i in range(num_cross_overs):
-                    receiver_choice = random.random()  # Choose which gene to receive the perturbation
-                    if receiver_choice < 0.5:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W1[ind_cr, :] = W2[ind_cr, :]
-                    else:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W2[ind_cr, :] = W1[ind_cr, :]
-
-            elif len(W1.shape) == 1: #Bias
-                num_variables = W1.shape[0]
-                # Crossover opertation [Indexed by row]
-                num_cross_overs = fastrand.pcg32bounded(num_variables)  # Lower bounded on full swaps
-                for i in range(num_cross_overs):
-                    receiver_choice = random.random()  # Choose which gene to receive the perturbation
-                    if receiver_choice < 0.5:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W1[ind_cr] = W2[ind_cr]
-                    else:
-                        ind_cr = fastrand.pcg32bounded(W1.shape[0])  #
-                        W2[ind_cr] = W1[ind_cr]
-
-        # Evaluate the children
+            parent_scores = [(self.opstat_score(gene1), self.opstat_score(gene2)) for gene1, gene2 in pairs]
+
+        with torch.no_grad():
+            params1 = zip(*[gene1.actor.parameters() for gene1, _ in pairs])
+            params2 = zip(*[gene2.actor.parameters() for _, gene2 in pairs])
+            for group1, group2 in zip(params1, params2):
+                W1 = torch.stack(group1)
+                W2 = torch.stack(group2)
+                num_variables = W1.shape[1]
+                if len(W1.shape) == 3: #Weights no bias
+                    max_crossovers = num_variables * 2
+                elif len(W1.shape) == 2: #Bias
+                    max_crossovers = num_variables
+                else:
+                    continue
+                to_gene1, to_gene2 = self.crossover_masks(len(pairs), num_variables, max_crossovers)
+                to_gene1 = to_gene1.view(to_gene1.shape + (1,) * (W1.dim() - 2))
+                to_gene2 = to_gene2.view(to_gene2.shape + (1,) * (W1.dim() - 2))
+                new_W1 = torch.where(to_gene1, W2, W1)
+                new_W2 = torch.where(to_gene2, W1, W2)
+                for b, (param1, param2) in enumerate(zip(group1, group2)):
+                    param1.copy_(new_W1[b])
+                    param2.copy_(new_W2[b])
+
+        # Scores of the children
         if self.args.opstat and self.stats.should_log():
-            test_score_c1 = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene1, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_c1 += episode['reward']
-            test_score_c1 /= trials
-
-            test_score_c2 = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene1, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_c2 += episode['reward']
-            test_score_c2 /= trials
+            for (gene1, gene2), (score_p1, score_p2) in zip(pairs, parent_scores):
+                self.opstat_records.append(("Classic Crossover", {
+                    'cros_parent1_fit': score_p1,
+                    'cros_parent2_fit': score_p2,
+                    'cros_child_fit': None,  # Mean of the two children
+                    'cros_child1_fit': self.opstat_score(gene1),
+                    'cros_child2_fit': self.opstat_score(gene2),
+                }))
+
+    def crossover_inplace(self, gene1: GeneticAgent, gene2: GeneticAgent):
+        self.crossover_batch([(gene1, gene2)])
 
-            if self.args.verbose_crossover:
-                print("==================== Classic Crossover ======================")
-                print("Parent 1", test_score_p1)
-                print("Parent 2", test_score_p2)
-                print("Child 1", test_score_c1)
-                print("Child 2", test_score_c2)
-
-            self.stats.add({
-                'cros_parent1_fit': test_score_p1,
-                'cros_parent2_fit': test_score_p2,
-                'cros_child_fit': np.mean([test_score_c1, test_score_c2]),
-                'cros_child1_fit': test_score_c1,
-                'cros_child2_fit': test_score_c2,
-            })
-    
     def distilation_crossover(self, gene1: GeneticAgent, gene2: GeneticAgent):
-        new_agent = GeneticAgent(self.args)
+        new_agent = GeneticAgent(self.args, gene1.shared_buffer)
         new_agent.buffer.add_latest_from(gene1.buffer, self.args.individual_bs // 2)
         new_agent.buffer.add_latest_from(gene2.buffer, self.args.individual_bs // 2)
         new_agent.buffer.shuffle()
@@ -137,49 +148,19 @@ class SSNE:
                 losses.append(new_agent.update_parameters(batch, gene1.actor, gene2.actor, self.critic))
 
         if self.args.opstat and self.stats.should_log():
-
-            test_score_p1 = 0
-            trials = 5
-            for eval in range(trials):
-                episode = self.evaluate(gene1, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_p1 += episode['reward']
-            test_score_p1 /= trials
-
-            test_score_p2 = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene2, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_p2 += episode['reward']
-            test_score_p2 /= trials
-
-            test_score_c = 0
-            for eval in range(trials):
-                episode = self.evaluate(new_agent, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_c += episode['reward']
-            test_score_c /= trials
-
             if self.args.verbose_crossover:
-                print("==================== Distillation Crossover ======================")
-                print("MSE Loss:", np.mean(losses[-40:]))
-                print("Parent 1", test_score_p1)
-                print("Parent 2", test_score_p2)
-                print("Crossover performance: ", test_score_c)
-
-            self.stats.add({
-                'cros_parent1_fit': test_score_p1,
-                'cros_parent2_fit': test_score_p2,
-                'cros_child_fit': test_score_c,
-            })
+                print("Distillation MSE Loss:", np.mean(losses[-40:]))
+            self.opstat_records.append(("Distillation Crossover", {
+                'cros_parent1_fit': self.opstat_score(gene1),
+                'cros_parent2_fit': self.opstat_score(gene2),
+                'cros_child_fit': self.opstat_score(new_agent),
+            }))
 
         return new_agent
 
     def mutate_inplace(self, gene: GeneticAgent):
-        trials = 5
         if self.stats.should_log():
-            test_score_p = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_p += episode['reward']
-            test_score_p /= trials
+            score_p = self.opstat_score(gene)
 
         mut_strength = 0.1
         num_mutation_frac = 0.1
@@ -187,129 +168,178 @@ class SSNE:
         super_mut_prob = 0.05
         reset_prob = super_mut_prob + 0.05
 
-        num_params = len(list(gene.actor.parameters()))
-        ssne_probabilities = np.random.uniform(0, 1, num_params) * 2
-        model_params = gene.actor.state_dict()
+        params = list(gene.actor.named_parameters())
+        ssne_probabilities = torch.rand(len(params), generator=self.generator, device=self.args.device) * 2
 
-        for i, key in enumerate(model_params): #Mutate each param
+        with torch.no_grad():
+            for i, (key, W) in enumerate(params): #Mutate each param
+                if is_lnorm_key(key) or len(W.shape) != 2: #Weights, no bias
+                    continue
 
-            if is_lnorm_key(key):
-                continue
+                if torch.rand(1, generator=self.generator, device=self.args.device) < ssne_probabilities[i]:
+                    num_weights = W.numel()
+                    num_mutations = torch.randint(int(math.ceil(num_mutation_frac * num_weights)), (1,),
+                                                  generator=self.generator, device=self.args.device)
+                    # The scalar version draws num_mutations indices with replacement, this is the probability
+                    # for a weight to be drawn at least once
+                    selected_prob = 1 - (1 - 1 / num_weights) ** num_mutations.float()
+                    selected = torch.rand(W.shape, generator=self.generator, device=self.args.device) < selected_prob
+                    kind = torch.rand(W.shape, generator=self.generator, device=self.args.device)
+                    noise = torch.randn(W.shape, generator=self.generator, device=self.args.device)
 
-            # References to the variable keys
-            W = model_params[key]
-            if len(W.shape) == 2: #Weights, no bias
+                    super_mask = selected & (kind < super_mut_prob)  # Super Mutation probability
+                    reset_mask = selected & (kind >= super_mut_prob) & (kind < reset_prob)  # Reset probability
+                    normal_mask = selected & (kind >= reset_prob)  # mutation even normal
 
-                num_weights= W.shape[0]*W.shape[1]
-                ssne_prob = ssne_probabilities[i]
+                    W.add_(noise * W * (super_mut_strength * super_mask + mut_strength * normal_mask))
+                    W.copy_(torch.where(reset_mask, noise, W))
 
-                if random.random() < ssne_prob:
-                    num_mutations = fastrand.pcg32bounded(int(math.ceil(num_mutation_frac * num_weights)))  # Number of mutation instances
-                    for _ in range(num_mutations):
-                        ind_dim1 = fastrand.pcg32bounded(W.shape[0])
-                        ind_dim2 = fastrand.pcg32bounded(W.shape[-1])
-                        random_num = random.random()
+                    # Regularization hard limit
+                    W.clamp_(-1000000, 1000000)
 
-                        if random_num < super_mut_prob:  # Super Mutation probability
-                            W[ind_dim1, ind_dim2] += random.gauss(0, super_mut_strength * W[ind_dim1, ind_dim2])
-                        elif random_num < reset_prob:  # Reset probability
-                            W[ind_dim1, ind_dim2] = random.gauss(0, 1)
-                        else:  # mutation even normal
-                            W[ind_dim1, ind_dim2] += random.gauss(0, mut_strength *W[ind_dim1, ind_dim2])
-
-                        # Regularization hard limit
-                        W[ind_dim1, ind_dim2] = self.regularize_weight(W[ind_dim1, ind_dim2], 1000000)
-
-        if self.stats.should_log():
-            test_score_c = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_c += episode['reward']
-            test_score_c /= trials
-
-            self.stats.add({
-                'mut_parent_fit': test_score_p,
-                'mut_child_fit': test_score_c,
-            })
-
-            if self.args.verbose_crossover:
-                print("==================== Mutation ======================")
-                print("Fitness before: ", test_score_p)
-                print("Fitness after: ", test_score_c)
-
-    def proximal_mutate(self, gene: GeneticAgent, mag):
-        # Based on code from https://github.com/uber-research/safemutations 
-        trials = 5
         if self.stats.should_log():
-            test_score_p = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_p += episode['reward']
-            test_score_p /= trials
+            self.opstat_records.append(("Mutation", {
+                'mut_parent_fit': score_p,
+                'mut_child_fit': self.opstat_score(gene),
+            }))
 
-        model = gene.actor
+    @staticmethod
+    def output_sensitivity(actors: List[Actor], states):
+        """
+        Sensitivity of the actions of each actor to its weights (the extract_parameters vector): the norm over
+        the action dimensions of the gradient of each action summed over a batch of states. The actors with
+        batches of the same size share a single vmap of jacrev over their stacked parameters.
+        :param actors: list of actors with the same architecture
+        :param states: list of (batch, state_dim) tensors, one per actor
+        :return: a (len(actors), count_parameters()) tensor
+        """
+        if not hasattr(torch, 'func'):  # torch.func comes with torch 2.0
+            return torch.stack([SSNE.backward_sensitivity(actor, state) for actor, state in zip(actors, states)])
+
+        model = actors[0]
+        weight_names = [name for name, param in flat_layout(model) if not is_lnorm_key(name) and len(param.shape) == 2]
+
+        def summed_output(weights, others, state):
+            return torch.func.functional_call(model, {**weights, **others}, (state,)).sum(0)
+
+        groups = {}
+        for i, state in enumerate(states):
+            groups.setdefault(len(state), []).append(i)
+        scaling = [None] * len(actors)
+        for indices in groups.values():
+            stacked = stack_actors([actors[i] for i in indices])
+            weights = {name: stacked.pop(name) for name in weight_names}
+            jacobian = torch.func.vmap(torch.func.jacrev(summed_output))(
+                weights, stacked, torch.stack([states[i] for i in indices]))
+            squares = torch.cat([jacobian[name].pow(2).sum(1).flatten(1) for name in weight_names], 1)
+            for i, row in zip(indices, squares.sqrt()):
+                scaling[i] = row
+        return torch.stack(scaling)
 
-        batch = gene.buffer.sample(min(self.args.mutation_batch_size, len(gene.buffer)))
-        state, _, _, _, _ = batch
+    @staticmethod
+    def backward_sensitivity(model: Actor, state):
+        """output_sensitivity of a single actor with one backward pass per action, used without torch.func"""
         output = model(state)
-
-        params = model.extract_parameters()
-        tot_size = model.count_parameters()
-        num_outputs = output.size()[1]
-
-        if self.args.mutation_noise:
-            mag_dist = dist.Normal(self.args.mutation_mag, 0.02)
-            mag = mag_dist.sample()
-
-        # initial perturbation
-        normal = dist.Normal(torch.zeros_like(params), torch.ones_like(params) * mag)
-        delta = normal.sample()
-        # uniform = delta.clone().detach().data.uniform_(0, 1)
-        # delta[uniform > 0.1] = 0.0
-
         # we want to calculate a jacobian of derivatives of each output's sensitivity to each parameter
-        jacobian = torch.zeros(num_outputs, tot_size).to(self.args.device)
-        grad_output = torch.zeros(output.size()).to(self.args.device)
+        jacobian = torch.zeros(output.shape[1], model.count_parameters(), device=output.device)
+        grad_output = torch.zeros_like(output)
 
         # do a backward pass for each output
-        for i in range(num_outputs):
+        for i in range(output.shape[1]):
             model.zero_grad()
             grad_output.zero_()
             grad_output[:, i] = 1.0
 
             output.backward(grad_output, retain_graph=True)
             jacobian[i] = model.extract_grad()
+        return torch.sqrt((jacobian**2).sum(0))
 
-        # summed gradients sensitivity
-        scaling = torch.sqrt((jacobian**2).sum(0))
-        scaling[scaling == 0] = 1.0
-        scaling[scaling < 0.01] = 0.01
-        delta /= scaling
-        new_params = params + delta
-
-        model.inject_parameters(new_params)
+    def proximal_mutate(self, gene: GeneticAgent, mag):
+        self.proximal_mutate_batch([gene], mag)
 
+    def proximal_mutate_batch(self, genes: List[GeneticAgent], mag):
+        # Based on code from https://github.com/uber-research/safemutations 
+        if len(genes) == 0:
+            return
         if self.stats.should_log():
-            test_score_c = 0
-            for eval in range(trials):
-                episode = self.evaluate(gene, is_render=False, is_action_noise=False, store_transition=False)
-                test_score_c += episode['reward']
-            test_score_c /= trials
+            scores_p = [self.opstat_score(gene) for gene in genes]
 
-            self.stats.add({
-                'mut_parent_fit': test_score_p,
-                'mut_child_fit': test_score_c,
-            })
+        states = []
+        for gene in genes:
+            batch = gene.buffer.sample(min(self.args.mutation_batch_size, len(gene.buffer)))
+            state, _, _, _, _ = batch
+            states.append(state)
+
+        # summed gradients sensitivity
+        scalings = self.output_sensitivity([gene.actor for gene in genes], states)
+
+        for i, (gene, scaling) in enumerate(zip(genes, scalings)):
+            model = gene.actor
+            params = model.extract_parameters()
+
+            gene_mag = mag
+            if self.args.mutation_noise:
+                mag_dist = dist.Normal(self.args.mutation_mag, 0.02)
+                gene_mag = mag_dist.sample()
+
+            # initial perturbation
+            normal = dist.Normal(torch.zeros_like(params), torch.ones_like(params) * gene_mag)
+            delta = normal.sample()
+
+            scaling[scaling == 0] = 1.0
+            scaling[scaling < 0.01] = 0.01
+            delta /= scaling
+            new_params = params + delta
+
+            model.inject_parameters(new_params)
+
+            if self.stats.should_log():
+                if self.args.verbose_crossover:
+                    print("Proximal mutation mean change:", torch.mean(torch.abs(new_params - params)).item())
+                self.opstat_records.append(("Mutation", {
+                    'mut_parent_fit': scores_p[i],
+                    'mut_child_fit': self.opstat_score(gene),
+                }))
+
+    def opstat_score(self, gene: GeneticAgent):
+        """
+        Score of the current weights of gene for the operator statistics. Weights evaluated during the
+        generation reuse their fitness, the others are copied and queued for the batched evaluation.
+        :return: the score, or the index of the queued snapshot as an OpstatSnapshot
+        """
+        key = fingerprint(gene.actor)
+        if key in self.known_fitness:
+            return self.known_fitness[key]
+        self.opstat_snapshots.append(ActorSnapshot(gene.actor))
+        return OpstatSnapshot(len(self.opstat_snapshots) - 1)
+
+    def evaluate_opstat(self):
+        """Evaluates all the queued snapshots in one batch and adds the operator statistics"""
+        if self.evaluate_many is not None:
+            scores = self.evaluate_many(self.opstat_snapshots, self.opstat_trials)
+        else:
+            scores = [np.mean([self.evaluate(snapshot, is_render=False, is_action_noise=False,
+                                             store_transition=False)['reward'] for _ in range(self.opstat_trials)])
+                      for snapshot in self.opstat_snapshots]
+
+        for title, record in self.opstat_records:
+            for k, v in record.items():
+                if isinstance(v, OpstatSnapshot):
+                    record[k] = scores[v.index]
+            if 'cros_child1_fit' in record:
+                record['cros_child_fit'] = np.mean([record['cros_child1_fit'], record['cros_child2_fit']])
+            self.stats.add(record)
 
             if self.args.verbose_crossover:
-                print("==================== Mutation ======================")
-                print("Fitness before: ", test_score_p)
-                print("Fitness after: ", test_score_c)
-                print("Mean mutation change:", torch.mean(torch.abs(new_params - params)).item())
+                print("==================== {} ======================".format(title))
+                for k, v in record.items():
+                    print(k, v)
+
+        self.opstat_snapshots = []
+        self.opstat_records = []
 
     def clone(self, master: GeneticAgent, replacee: GeneticAgent):  # Replace the replacee individual with master
-        for target_param, source_param in zip(replacee.actor.parameters(), master.actor.parameters()):
-            target_param.data.copy_(source_param.data)
+        hard_update(replacee.actor, master.actor)
         replacee.buffer.reset()
         replacee.buffer.add_content_of(master.buffer)
 
@@ -345,6 +375,10 @@ class SSNE:
         return sorted(groups, key=lambda group: group[2], reverse=True)
 
     def epoch(self, pop: List[GeneticAgent], fitness_evals):
+        # The parents of the operators reuse the fitness of this generation when their weights are unchanged
+        if self.stats.should_log():
+            self.known_fitness = {fingerprint(gene.actor): fitness for gene, fitness in zip(pop, fitness_evals)}
+
         # Entire epoch is handled with indices; Index rank nets by fitness evaluation (0 is the best after reversing)
         index_rank = np.argsort(fitness_evals)[::-1]
         elitist_index = index_rank[:self.num_elitists]  # Elitist indexes safeguard
@@ -392,12 +426,19 @@ class SSNE:
         else:
             if len(unselects) % 2 != 0:  # Number of unselects left should be even
                 unselects.append(unselects[fastrand.pcg32bounded(len(unselects))])
+            # The crossovers are batched, a batch ends before a gene that it already contains is cloned again
+            pairs, crossed = [], set()
             for i, j in zip(unselects[0::2], unselects[1::2]):
+                if i in crossed or j in crossed:
+                    self.crossover_batch(pairs)
+                    pairs, crossed = [], set()
                 off_i = random.choice(new_elitists)
                 off_j = random.choice(offsprings)
                 self.clone(master=pop[off_i], replacee=pop[i])
                 self.clone(master=pop[off_j], replacee=pop[j])
-                self.crossover_inplace(pop[i], pop[j])
+                pairs.append((pop[i], pop[j]))
+                crossed.update((i, j))
+            self.crossover_batch(pairs)
 
         # Crossover for selected offsprings
         for i in offsprings:
@@ -407,21 +448,40 @@ class SSNE:
                 off_j = random.choice(others)
                 self.clone(self.distilation_crossover(pop[i], pop[off_j]), pop[i])
 
-        # Mutate all genes in the population except the new elitists
+        # Mutate all genes in the population except the new elitists, the proximal mutations as one batch
+        proximal = []
         for i in range(self.population_size):
             if i not in new_elitists:  # Spare the new elitists
                 if random.random() < self.args.mutation_prob:
                     if self.args.proximal_mut:
-                        self.proximal_mutate(pop[i], mag=self.args.mutation_mag)
+                        proximal.append(pop[i])
                     else:
                         self.mutate_inplace(pop[i])
+        self.proximal_mutate_batch(proximal, mag=self.args.mutation_mag)
 
         if self.stats.should_log():
+            self.evaluate_opstat()
             self.stats.log()
         self.stats.reset()
         return new_elitists[0]
 
 
+class ActorSnapshot:
+    """Copy of the actor of an individual, as it was when an operator statistic was recorded"""
+
+    def __init__(self, actor):
+        self.actor = Actor(actor.args)
+        hard_update(self.actor, actor)
+        self.buffer = None
+
+
+class OpstatSnapshot:
+    """Placeholder for the score of a queued snapshot in an operator statistic record"""
+
+    def __init__(self, index):
+        self.index = index
+
+
 def unsqueeze(array, axis=1):
     if axis == 0: return np.reshape(array, (1, len(array)))
     elif axis == 1: return np.reshape(array, (len(array), 1))
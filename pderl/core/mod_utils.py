@@ -152,6 +152,12 @@ def fanin_init(size, fanin=None):
     v = 0.008
     return torch.Tensor(size).uniform_(-v, v)
 
+def mean_loss(losses):
+    """Mean of a list of scalar loss tensors, moved to the host once. nan for an empty list, as np.mean"""
+    if len(losses) == 0:
+        return np.nan
+    return torch.stack(losses).mean().item()
+
 def to_numpy(var):
     return var.data.numpy()
 
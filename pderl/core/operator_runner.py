@@ -1,8 +1,8 @@
 import os
-import pickle
 import numpy as np
 import torch
 from core import ddpg
+from core import replay_memory
 from core import mod_neuro_evo
 
 
@@ -13,18 +13,23 @@ class OperatorRunner:
 
     def load_genetic_agent(self, source, model):
         actor_path = os.path.join(source, 'evo_net_actor_{}.pkl'.format(model))
-        buffer_path = os.path.join(source, 'champion_buffer_{}.pkl'.format(model))
+        buffer_path = os.path.join(source, 'champion_buffer_{}.npz'.format(model))
+
+        # Buffers saved before the snapshot format are converted once
+        legacy_path = os.path.join(source, 'champion_buffer_{}.pkl'.format(model))
+        if not os.path.exists(buffer_path) and os.path.exists(legacy_path):
+            replay_memory.convert_legacy_buffer(legacy_path, buffer_path)
 
         agent = ddpg.GeneticAgent(self.args)
         agent.actor.load_state_dict(torch.load(actor_path))
-        with open(buffer_path, 'rb') as file:
-            agent.buffer = pickle.load(file)
+        agent.buffer.load(buffer_path)
 
         return agent
 
     def evaluate(self, agent, trials=10):
         results = []
         states = []
+        policy = agent.actor.numpy_policy()
         for trial in range(trials):
             total_reward = 0
 
@@ -33,7 +38,7 @@ class OperatorRunner:
                 states.append(state)
             done = False
             while not done:
-                action = agent.actor.select_action(np.array(state))
+                action = policy.select_action(state)
 
                 # Simulate one step in environment
                 next_state, reward, done, info = self.env.step(action.flatten())
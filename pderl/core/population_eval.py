@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+from core.ddpg import flat_parameters
+from core.population_store import unflatten
+from core.replay_memory import Transition
+
+
+def stack_actors(actors):
+    """
+    Stacks the parameters of several actors along a new first dimension
+    :param actors: a list of Actor with the same architecture
+    :return: a dict from parameter name to a (len(actors), ...) tensor
+    """
+    flats = [flat_parameters(actor) for actor in actors]
+    if all(flat is not None for flat in flats):  # One copy per actor with a PopulationStore
+        return unflatten(torch.stack(flats).detach(), actors[0])
+    names = [name for name, _ in actors[0].named_parameters()]
+    params = [dict(actor.named_parameters()) for actor in actors]
+    return {name: torch.stack([p[name].detach() for p in params]) for name in names}
+
+
+def layer_norm(x, gamma, beta, eps=1e-6):
+    # Same normalisation as ddpg.LayerNorm, with one set of gains per row
+    mean = x.mean(-1, keepdim=True)
+    std = x.std(-1, keepdim=True)
+    return gamma * (x - mean) / (std + eps) + beta
+
+
+def population_forward(stacked, states, use_ln):
+    """
+    Runs the forward pass of Actor for a batch of states, each row with its own weights
+    :param stacked: a dict of stacked parameters, already indexed to have one entry per row of states
+    :param states: a (n, state_dim) tensor
+    :return: a (n, action_dim) tensor of actions
+    """
+    out = torch.baddbmm(stacked['w_l1.bias'].unsqueeze(1), states.unsqueeze(1),
+                        stacked['w_l1.weight'].transpose(1, 2)).squeeze(1)
+    if use_ln: out = layer_norm(out, stacked['lnorm1.gamma'], stacked['lnorm1.beta'])
+    out = out.tanh()
+
+    out = torch.baddbmm(stacked['w_l2.bias'].unsqueeze(1), out.unsqueeze(1),
+                        stacked['w_l2.weight'].transpose(1, 2)).squeeze(1)
+    if use_ln: out = layer_norm(out, stacked['lnorm2.gamma'], stacked['lnorm2.beta'])
+    out = out.tanh()
+
+    out = torch.baddbmm(stacked['w_out.bias'].unsqueeze(1), out.unsqueeze(1),
+                        stacked['w_out.weight'].transpose(1, 2)).squeeze(1)
+    return out.tanh()
+
+
+class PopulationEvaluator:
+    """
+    Plays the episodes of a whole population in lockstep, one environment copy per episode. At every step
+    the actions of all the running episodes come from a single batched forward pass.
+    """
+
+    def __init__(self, args, make_env):
+        self.args = args
+        self.make_env = make_env
+        self.envs = []
+
+    def _get_envs(self, num):
+        while len(self.envs) < num:
+            env = self.make_env()
+            env.seed(self.args.seed + len(self.envs) + 1)
+            self.envs.append(env)
+        return self.envs[:num]
+
+    def evaluate(self, agents, num_evals, store_transition=True):
+        """
+        Plays num_evals episodes with every agent
+        :param agents: the list of agents to evaluate
+        :param num_evals: the number of episodes per agent
+        :param store_transition: whether to collect the transitions of the episodes
+        :return: a list with, for each episode, the agent index, the reward and the transitions (or None)
+        """
+        num_episodes = len(agents) * num_evals
+        owners = np.repeat(np.arange(len(agents)), num_evals)
+        envs = self._get_envs(num_episodes)
+
+        with torch.no_grad():
+            stacked = stack_actors([agent.actor for agent in agents])
+            states = [env.reset() for env in envs]
+            rewards = np.zeros(num_episodes)
+            steps = [[] for _ in range(num_episodes)]
+            running = np.arange(num_episodes)
+            episode_params = None
+
+            while len(running) > 0:
+                # Only the episodes that are still running take part in the forward pass, their parameters
+                # are gathered again only after some episodes ended
+                if episode_params is None:
+                    episode_params = {name: param[owners[running]] for name, param in stacked.items()}
+                batch = torch.as_tensor(np.array([states[i] for i in running]), dtype=torch.float32,
+                                        device=self.args.device)
+                actions = population_forward(episode_params, batch, self.args.use_ln).cpu().numpy()
+
+                still_running = []
+                for i, action in zip(running, actions):
+                    next_state, reward, done, info = envs[i].step(action.flatten())
+                    rewards[i] += reward
+                    if store_transition:
+                        steps[i].append((states[i], action, next_state, reward, float(done)))
+                    states[i] = next_state
+                    if not done:
+                        still_running.append(i)
+                if len(still_running) < len(running):
+                    running = np.array(still_running, dtype=np.int64)
+                    episode_params = None
+
+        episodes = []
+        for i in range(num_episodes):
+            transitions = Transition(*[np.array(field) for field in zip(*steps[i])]) if store_transition else None
+            episodes.append({'index': owners[i], 'reward': rewards[i], 'transitions': transitions})
+        return episodes
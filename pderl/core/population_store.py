@@ -0,0 +1,44 @@
+import torch
+from core.ddpg import flat_layout
+
+
+def unflatten(flat, actor):
+    """
+    Splits a batch of flat parameter vectors into views of the parameters of an actor
+    :param flat: a (n, P) tensor of parameters in flat_layout order
+    :param actor: an Actor with the same architecture
+    :return: a dict from parameter name to a (n, ...) view of flat
+    """
+    stacked = {}
+    offset = 0
+    for name, param in flat_layout(actor):
+        stacked[name] = flat[:, offset:offset + param.numel()].view((flat.shape[0],) + param.shape)
+        offset += param.numel()
+    return stacked
+
+
+class PopulationStore:
+    """
+    The parameters of a set of actors in one contiguous (len(actors), P) tensor. The parameters of every
+    actor become views into its row, in flat_layout order, so hard_update between two of them is a single
+    row copy and ddpg.flat_parameters returns the row without copying. The Parameter objects are kept, so
+    the optimizers built on them stay valid.
+    """
+
+    def __init__(self, actors):
+        layout = flat_layout(actors[0])
+        size = sum(param.numel() for _, param in layout)
+        self.weights = torch.empty(len(actors), size, dtype=layout[0][1].dtype, device=layout[0][1].device)
+        self.actor = actors[0]
+
+        for row, actor in zip(self.weights, actors):
+            offset = 0
+            for _, param in flat_layout(actor):
+                view = row[offset:offset + param.numel()].view_as(param)
+                view.copy_(param.data)
+                param.data = view
+                offset += param.numel()
+
+    def stacked(self):
+        """The parameters of all the actors as a dict of (len(actors), ...) views, see population_forward"""
+        return unflatten(self.weights, self.actor)
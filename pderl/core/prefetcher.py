@@ -0,0 +1,68 @@
+import queue
+import threading
+import numpy as np
+
+
+class BatchPrefetcher(object):
+    """
+    Samples minibatches from a replay buffer in a background thread and keeps up to queue_size of them
+    ready for the learner. The thread draws its indices from its own RandomState, so the sequence of
+    minibatches only depends on the seed and not on thread timing.
+
+    starved counts the minibatches the learner had to wait for, full counts the ones the sampler had to
+    hold back because the queue was full. A high starved count means sampling is the bottleneck.
+    """
+
+    def __init__(self, memory, num_batches, batch_size, seed, queue_size=8, batches_per_draw=32):
+        self.memory = memory
+        self.num_batches = num_batches
+        self.batch_size = batch_size
+        self.batches_per_draw = batches_per_draw
+        self.rng = np.random.RandomState(seed)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.starved = 0
+        self.full = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        if self.queue.full():
+            self.full += 1
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for start in range(0, self.num_batches, self.batches_per_draw):
+                num = min(self.batches_per_draw, self.num_batches - start)
+                batches = self.memory.sample_many(num, self.batch_size, rng=self.rng)
+                for batch in zip(*batches):
+                    if not self._put(batch):
+                        return
+        except Exception as e:
+            # Handed over to the learner thread which raises it from get()
+            self._put(e)
+
+    def get(self):
+        if self.queue.empty():
+            self.starved += 1
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
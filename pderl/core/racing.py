@@ -0,0 +1,72 @@
+import numpy as np
+
+
+def protected_ranks(pop_size, num_elitists, tournament_size=3, coverage=0.95):
+    """
+    Number of top ranks an individual has to be able to reach to matter for SSNE.epoch: the elites and
+    the ranks that together win a coverage fraction of the tournaments
+    """
+    # A tournament with replacement is won by rank r (0 is the best) with P(min rank >= r) - P(min rank > r)
+    for rank in range(pop_size + 1):
+        if 1 - ((pop_size - rank) / pop_size) ** tournament_size >= coverage:
+            break
+    return max(num_elitists, rank)
+
+
+class FitnessRace:
+    """
+    Racing evaluation of the population fitness. The individuals play num_evals episodes in rounds of one
+    episode each, and after every round an individual stops playing once at least num_protected others
+    are confidently better than it, i.e. its upper confidence bound is below their lower bounds.
+
+    The bounds are mean +- z * noise / sqrt(episodes), where noise is the pooled standard deviation of the
+    episode returns of the same individual, measured on the previous generation. Without an estimate
+    (first generation or num_evals of 1) every episode is played.
+    """
+
+    def __init__(self, num_evals, num_protected, z=2.0):
+        self.num_evals = num_evals
+        self.num_protected = num_protected
+        self.z = z
+        self.noise = None
+        self.frames_saved = 0
+
+    def bounds(self, returns):
+        counts = np.array([len(r) for r in returns])
+        means = np.array([np.mean(r) for r in returns])
+        width = self.z * self.noise / np.sqrt(counts)
+        return means - width, means + width
+
+    def run(self, play, pop_size):
+        """
+        Runs the race
+        :param play: function playing one episode with each of the given individual indices and returning
+        their rewards and lengths
+        :param pop_size: the number of individuals
+        :return: the mean return of each individual over the episodes it played
+        """
+        returns = [[] for _ in range(pop_size)]
+        lengths = [[] for _ in range(pop_size)]
+        alive = np.arange(pop_size)
+
+        for episode in range(self.num_evals):
+            rewards, steps = play(alive)
+            for i, reward, length in zip(alive, rewards, steps):
+                returns[i].append(reward)
+                lengths[i].append(length)
+
+            if self.noise is None or episode == self.num_evals - 1:
+                continue
+            lower, upper = self.bounds(returns)
+            cutoff = np.sort(lower)[::-1][self.num_protected - 1]
+            alive = np.array([i for i in alive if upper[i] >= cutoff], dtype=np.int64)
+
+        # Episodes left out by the race, counted at the mean length of the episodes the individual played
+        self.frames_saved = sum((self.num_evals - len(returns[i])) * np.mean(lengths[i]) for i in range(pop_size))
+
+        # Pooled within individual deviation of the returns, for the next generation
+        dof = sum(len(r) - 1 for r in returns)
+        if dof > 0:
+            self.noise = np.sqrt(sum(np.sum((np.array(r) - np.mean(r)) ** 2) for r in returns) / dof)
+
+        return np.array([np.mean(r) for r in returns])
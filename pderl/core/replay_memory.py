@@ -1,8 +1,12 @@
-import random
+import os
+import json
+import mmap
+import pickle
 import torch
 import numpy as np
 from collections import namedtuple
 from core import mod_utils as utils
+from core.segment_tree import SumSegmentTree, MinSegmentTree
 
 # Taken and adapted from
 # https://github.com/pytorch/tutorials/blob/master/Reinforcement%20(Q-)Learning%20with%20PyTorch.ipynb
@@ -10,52 +14,142 @@ from core import mod_utils as utils
 Transition = namedtuple(
     'Transition', ('state', 'action', 'next_state', 'reward', 'done'))
 
+TORCH_DTYPES = {np.dtype(np.float16): torch.float16, np.dtype(np.float32): torch.float32,
+                np.dtype(np.bool_): torch.bool}
 
-class ReplayMemory(object):
 
-    def __init__(self, capacity, device):
+SNAPSHOT_VERSION = 1
+
+
+def field_dtypes(obs_dtype):
+    """Storage types of the fields, observations in obs_dtype and the done flags as booleans"""
+    return Transition(np.dtype(obs_dtype), np.dtype(np.float32), np.dtype(obs_dtype), np.dtype(np.float32),
+                      np.dtype(np.bool_))
+
+
+class ReplayMemory(object):
+    """
+    Ring buffer of transitions stored as one contiguous array per field.
+    The arrays are allocated on the first insertion, once the shape of each field is known.
+    Observations are kept in obs_dtype (float32 or float16) and the done flags as booleans,
+    everything is decoded to float32 tensors when sampled.
+    """
+
+    def __init__(self, capacity, device, obs_dtype=np.float32):
         self.device = device
         self.capacity = capacity
-        self.memory = []
+        self.dtypes = field_dtypes(obs_dtype)
+        self.storage = None
         self.position = 0
+        self.size = 0
+        self.total = 0  # Number of insertions so far, the i-th insertion lives in slot i % capacity
+
+    def _allocate(self, args):
+        self.storage = Transition(*[np.empty((self.capacity, np.size(arg)), dtype=dtype)
+                                    for arg, dtype in zip(args, self.dtypes)])
 
     def add(self, *args):
         """Saves a transition."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
+        if self.storage is None:
+            self._allocate(args)
 
-        reshaped_args = []
-        for arg in args:
-            reshaped_args.append(np.reshape(arg, (1, -1)))
+        for field, arg in zip(self.storage, args):
+            field[self.position] = np.reshape(arg, -1)
 
-        self.memory[self.position] = Transition(*reshaped_args)
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.total += 1
+
+    def extend(self, *args):
+        """
+        Saves a block of transitions with slice copies, wrapping around the end of the ring
+        :param args: one array per field holding n transitions along the first axis
+        """
+        num = len(args[0])
+        if num == 0:
+            return
+        args = [self._block(arg, num) for arg in args]
+        if self.storage is None:
+            self._allocate([arg[0] for arg in args])
+
+        args = self._trim(args)
+        self._write(self.storage, args)
+        self._advance(len(args[0]))
+
+    def _trim(self, args):
+        """Only the last transitions survive when the block is larger than the buffer"""
+        num = len(args[0])
+        if num <= self.capacity:
+            return args
+        self.position = (self.position + num - self.capacity) % self.capacity
+        self.total += num - self.capacity
+        return [arg[-self.capacity:] for arg in args]
+
+    def _write(self, fields, args):
+        """Copies the blocks into the fields starting at the cursor, wrapping around the end of the ring"""
+        num = len(args[0])
+        first = min(num, self.capacity - self.position)
+        for field, arg in zip(fields, args):
+            field[self.position:self.position + first] = arg[:first]
+            field[:num - first] = arg[first:]
+
+    def _advance(self, num):
+        self.position = (self.position + num) % self.capacity
+        self.size = min(self.size + num, self.capacity)
+        self.total += num
+
+    def _block(self, arg, num):
+        if torch.is_tensor(arg):
+            arg = arg.cpu().numpy()
+        return np.reshape(arg, (num, -1))
+
+    def _latest_segments(self, latest):
+        """
+        Returns the contiguous (start, stop) slot ranges holding the latest elements, oldest first
+        :param latest: the number of latest elements
+        """
+        latest = min(latest, self.size)
+        if latest == 0:
+            return []
+        start = (self.position - latest) % self.capacity
+        if start + latest <= self.capacity:
+            return [(start, start + latest)]
+        return [(start, self.capacity), (0, start + latest - self.capacity)]
+
+    def copy_from(self, other, latest):
+        """
+        Copies the latest elements of another replay buffer into this buffer, block by block
+        :param other: another replay buffer
+        :param latest: the number of elements to copy
+        """
+        for start, stop in other._latest_segments(latest):
+            self.extend(*other._segment(start, stop))
+
+    def _segment(self, start, stop):
+        return Transition(*[field[start:stop] for field in self.storage])
 
     def add_content_of(self, other):
         """
         Adds the content of another replay buffer to this replay buffer
         :param other: another replay buffer
         """
-        latest_trans = other.get_latest(self.capacity)
-        for transition in latest_trans:
-            self.add(*transition)
+        self.copy_from(other, self.capacity)
+
+    def _latest_indices(self, latest):
+        """
+        Returns the slots of the latest elements, ordered from the oldest to the most recent one
+        :param latest: the number of latest elements
+        """
+        latest = min(latest, self.size)
+        return (self.position - latest + np.arange(latest)) % self.capacity
 
     def get_latest(self, latest):
         """
-        Returns the latest element from the other buffer with the most recent ones at the end of the returned list
-        :param other: another replay buffer
+        Returns the latest elements of the buffer with the most recent ones at the end
         :param latest: the number of latest elements to return
-        :return: a list with the latest elements
-        """
-        if self.capacity < latest:
-            latest_trans = self.memory[self.position:].copy() + self.memory[:self.position].copy()
-        elif len(self.memory) < self.capacity:
-            latest_trans = self.memory[-latest:].copy()
-        elif self.position >= latest:
-            latest_trans = self.memory[:self.position][-latest:].copy()
-        else:
-            latest_trans = self.memory[-latest+self.position:].copy() + self.memory[:self.position].copy()
-        return latest_trans
+        :return: a Transition holding one (n, dim) array per field
+        """
+        return self._fetch(self._latest_indices(latest))
 
     def add_latest_from(self, other, latest):
         """
@@ -63,101 +157,572 @@ class ReplayMemory(object):
         :param other: another replay buffer
         :param latest: the number of elements to add
         """
-        latest_trans = other.get_latest(latest)
-        for transition in latest_trans:
-            self.add(*transition)
+        self.copy_from(other, latest)
 
     def shuffle(self):
-        random.shuffle(self.memory)
+        if self.size == 0:
+            return
+        permutation = np.random.permutation(self.size)
+        for field in self.storage:
+            field[:self.size] = field[permutation]
+
+    def _fetch(self, indices):
+        if self.storage is None:
+            return Transition(*[np.empty((0, 1), dtype=np.float32) for _ in Transition._fields])
+        return Transition(*[field[indices] for field in self.storage])
+
+    def _gather(self, indices):
+        return tuple(torch.from_numpy(field).to(self.device).float() for field in self._fetch(indices))
 
     def sample(self, batch_size):
-        transitions = random.sample(self.memory, batch_size)
-        batch = Transition(*zip(*transitions))
+        indices = np.random.randint(0, self.size, size=batch_size)
+        return self._gather(indices)
 
-        state = torch.FloatTensor(np.concatenate(batch.state)).to(self.device)
-        action = torch.FloatTensor(np.concatenate(batch.action)).to(self.device)
-        next_state = torch.FloatTensor(np.concatenate(batch.next_state)).to(self.device)
-        reward = torch.FloatTensor(np.concatenate(batch.reward)).to(self.device)
-        done = torch.FloatTensor(np.concatenate(batch.done)).to(self.device)
-        return state, action, next_state, reward, done
+    def sample_many(self, num_batches, batch_size, rng=np.random):
+        """
+        Samples several minibatches with a single index draw and one gather per field
+        :param rng: the numpy random generator drawing the indices
+        :return: one (num_batches, batch_size, dim) tensor per field
+        """
+        indices = rng.randint(0, self.size, size=num_batches * batch_size)
+        return tuple(field.view(num_batches, batch_size, -1) for field in self._gather(indices))
 
     def sample_from_latest(self, batch_size, latest):
-        latest_trans = self.get_latest(latest)
-        transitions = random.sample(latest_trans, batch_size)
-        batch = Transition(*zip(*transitions))
+        latest_indices = self._latest_indices(latest)
+        indices = latest_indices[np.random.randint(0, len(latest_indices), size=batch_size)]
+        return self._gather(indices)
 
-        state = torch.FloatTensor(np.concatenate(batch.state)).to(self.device)
-        action = torch.FloatTensor(np.concatenate(batch.action)).to(self.device)
-        next_state = torch.FloatTensor(np.concatenate(batch.next_state)).to(self.device)
-        reward = torch.FloatTensor(np.concatenate(batch.reward)).to(self.device)
-        done = torch.FloatTensor(np.concatenate(batch.done)).to(self.device)
-        return state, action, next_state, reward, done
+    def __len__(self):
+        return self.size
+
+    def reset(self):
+        # Keep the allocated arrays around, they are overwritten by the next insertions
+        self.position = 0
+        self.size = 0
+        self.total = 0
+
+    def materialize(self):
+        return self
+
+    def save(self, path, compressed=True):
+        """
+        Writes a snapshot of the buffer: one array per field, oldest transition first, plus a small header
+        :param path: the .npz file to write
+        :param compressed: whether to compress the arrays
+        """
+        snapshot = self.get_latest(self.size)._asdict()
+        snapshot['capacity'] = np.array(self.capacity)
+        snapshot['version'] = np.array(SNAPSHOT_VERSION)
+        (np.savez_compressed if compressed else np.savez)(path, **snapshot)
+
+    def load(self, path):
+        """
+        Replaces the content of the buffer with a snapshot written by save, in a single bulk insertion
+        :param path: the .npz file to read
+        """
+        with np.load(path) as snapshot:
+            fields = [snapshot[name] for name in Transition._fields]
+        self.reset()
+        self.extend(*fields)
+
+
+class MemmapReplayMemory(ReplayMemory):
+    """
+    ReplayMemory whose field arrays are np.memmap files in a folder, for capacities beyond RAM.
+    Once about cache_budget bytes have been written or gathered, the mapped pages are flushed and
+    released so the resident size of the process stays bounded. The folder can be reopened
+    read-only for offline analysis with MemmapReplayMemory.open.
+    """
+
+    header_file = 'header.json'
+
+    def __init__(self, capacity, device, folder, cache_budget=1 << 30, obs_dtype=np.float32):
+        super().__init__(capacity, device, obs_dtype)
+        self.folder = folder
+        self.cache_budget = cache_budget
+        self.touched = 0
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def _field_path(self, name):
+        return os.path.join(self.folder, name + '.dat')
+
+    def _allocate(self, args):
+        self.storage = Transition(*[np.memmap(self._field_path(name), dtype=dtype, mode='w+',
+                                              shape=(self.capacity, np.size(arg)))
+                                    for name, arg, dtype in zip(Transition._fields, args, self.dtypes)])
+        self.write_header()
+
+    def _touch(self, rows):
+        self.touched += rows * sum(field.shape[1] * field.itemsize for field in self.storage)
+        if self.touched > self.cache_budget:
+            self.flush()
+
+    def add(self, *args):
+        super().add(*args)
+        self._touch(1)
+
+    def extend(self, *args):
+        super().extend(*args)
+        self._touch(len(args[0]))
+
+    def _fetch(self, indices):
+        batch = super()._fetch(indices)
+        if self.storage is not None:
+            self._touch(len(indices))
+        return batch
+
+    def write_header(self):
+        header = {
+            'capacity': self.capacity,
+            'position': self.position,
+            'size': self.size,
+            'total': self.total,
+            'dims': [field.shape[1] for field in self.storage],
+            'dtypes': [field.dtype.str for field in self.storage],
+        }
+        with open(os.path.join(self.folder, self.header_file), 'w') as f:
+            json.dump(header, f)
+
+    def flush(self):
+        """Writes the dirty pages and the header to disk and drops the mapped pages from memory"""
+        self.touched = 0
+        if self.storage is None:
+            return
+        for field in self.storage:
+            if field.mode != 'r':
+                field.flush()
+            if hasattr(mmap, 'MADV_DONTNEED') and getattr(field, '_mmap', None) is not None:
+                field._mmap.madvise(mmap.MADV_DONTNEED)
+        if self.storage.state.mode != 'r':
+            self.write_header()
+
+    @classmethod
+    def open(cls, folder, device='cpu', cache_budget=1 << 30):
+        """
+        Reopens a folder written by a MemmapReplayMemory in read-only mode
+        :param folder: the folder holding the header and the field files
+        :return: a MemmapReplayMemory that can be sampled but not written
+        """
+        with open(os.path.join(folder, cls.header_file)) as f:
+            header = json.load(f)
+        memory = cls(header['capacity'], device, folder, cache_budget)
+        memory.dtypes = Transition(*[np.dtype(dtype) for dtype in header['dtypes']])
+        memory.storage = Transition(*[np.memmap(memory._field_path(name), dtype=dtype, mode='r',
+                                                shape=(header['capacity'], dim))
+                                      for name, dim, dtype in zip(Transition._fields, header['dims'], memory.dtypes)])
+        memory.position = header['position']
+        memory.size = header['size']
+        memory.total = header['total']
+        return memory
+
+
+class TorchReplayMemory(ReplayMemory):
+    """
+    ReplayMemory that keeps its field arrays as tensors on the training device. sample() and sample_many()
+    gather into preallocated batch tensors which the next draw of the same size overwrites, so a learner
+    step does no host side allocation.
+    """
+
+    def __init__(self, capacity, device, obs_dtype=np.float32):
+        super().__init__(capacity, device, obs_dtype)
+        self.batches = {}
+
+    def _allocate(self, args):
+        self.storage = Transition(*[torch.empty((self.capacity, arg.numel()), dtype=TORCH_DTYPES[dtype],
+                                                device=self.device)
+                                    for arg, dtype in zip(args, self.dtypes)])
+
+    def _block(self, arg, num):
+        if torch.is_tensor(arg):
+            return arg.reshape(num, -1).to(self.device, torch.float32)
+        return torch.from_numpy(np.asarray(arg, dtype=np.float32).reshape(num, -1)).to(self.device)
+
+    def add(self, *args):
+        """Saves a transition."""
+        self.extend(*[np.reshape(arg, (1, -1)) for arg in args])
+
+    def shuffle(self):
+        if self.size == 0:
+            return
+        permutation = torch.randperm(self.size, device=self.device)
+        for field in self.storage:
+            field[:self.size] = field[permutation]
+
+    def _fetch(self, indices):
+        if self.storage is None:
+            return super()._fetch(indices)
+        return Transition(*[field.cpu().numpy() for field in self._gather(indices)])
+
+    def _gather(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long, device=self.device)
+        return tuple(field.index_select(0, indices).float() for field in self.storage)
+
+    def _draw(self, num):
+        """Gathers num uniformly drawn transitions into the preallocated tensors of that size"""
+        if num not in self.batches:
+            raw = tuple(torch.empty((num, field.shape[1]), dtype=field.dtype, device=self.device)
+                        for field in self.storage)
+            decoded = tuple(out if out.dtype == torch.float32 else torch.empty(out.shape, device=self.device)
+                            for out in raw)
+            self.batches[num] = (torch.empty(num, dtype=torch.long, device=self.device), raw, decoded)
+        indices, raw, decoded = self.batches[num]
+
+        torch.randint(self.size, (num,), out=indices)
+        for field, out, batch in zip(self.storage, raw, decoded):
+            torch.index_select(field, 0, indices, out=out)
+            if batch is not out:
+                batch.copy_(out)
+        return decoded
+
+    def sample(self, batch_size):
+        return self._draw(batch_size)
+
+    def sample_many(self, num_batches, batch_size, rng=None):
+        """
+        Samples several minibatches with one draw. Without rng the indices are drawn on the device and the
+        minibatches are views of preallocated tensors, valid until the next draw of the same size.
+        :param rng: the numpy random generator drawing the indices, the batches are then new tensors
+        """
+        if rng is not None:
+            return super().sample_many(num_batches, batch_size, rng)
+        return tuple(batch.view(num_batches, batch_size, -1) for batch in self._draw(num_batches * batch_size))
+
+
+class DedupReplayMemory(ReplayMemory):
+    """
+    ReplayMemory that stores every observation once. The next state of a transition is the state of the
+    following slot, unless the slot is flagged as the last one of a chain (end of an episode, newest
+    transition or a block whose next state is not the following state). The next states of those slots
+    are kept aside in a small dictionary. storage.next_state is None.
+    """
+
+    def __init__(self, capacity, device, obs_dtype=np.float32):
+        super().__init__(capacity, device, obs_dtype)
+        self.last = np.zeros(capacity, dtype=np.bool_)
+        self.final = {}
+
+    def _allocate(self, args):
+        super()._allocate(args)
+        self.storage = self.storage._replace(next_state=None)
+
+    def add(self, *args):
+        """Saves a transition."""
+        if self.storage is None:
+            self._allocate(args)
+        state, action, next_state, reward, done = [np.reshape(arg, -1) for arg in args]
+
+        self._link_newest(state)
+        slot = self.position
+        if self.last[slot]:
+            self.final.pop(slot, None)
+        self.storage.state[slot] = state
+        self.storage.action[slot] = action
+        self.storage.reward[slot] = reward
+        self.storage.done[slot] = done
+        self.last[slot] = True
+        self.final[slot] = next_state.astype(self.dtypes.next_state)
+        self._advance(1)
+
+    def _link_newest(self, state):
+        """Lets the newest stored transition continue into a new one starting from state"""
+        if self.size == 0:
+            return
+        newest = (self.position - 1) % self.capacity
+        final = self.final.get(newest)
+        if final is not None and np.array_equal(final, state.astype(self.dtypes.state)):
+            self.last[newest] = False
+            del self.final[newest]
+
+    def extend(self, *args):
+        num = len(args[0])
+        if num == 0:
+            return
+        args = [self._block(arg, num) for arg in args]
+        if self.storage is None:
+            self._allocate([arg[0] for arg in args])
+
+        trimmed = num > self.capacity
+        state, action, next_state, reward, done = self._trim(args)
+        num = len(state)
+
+        # A row continues into the next one when its next state is the state that follows
+        chained = np.zeros(num, dtype=np.bool_)
+        chained[:-1] = np.all(next_state[:-1] == state[1:], axis=1)
+
+        # The first row may continue the newest transition already stored
+        if not trimmed:
+            self._link_newest(state[0])
+
+        slots = (self.position + np.arange(num)) % self.capacity
+        for slot in slots[self.last[slots]]:
+            self.final.pop(slot, None)
+        for row in np.flatnonzero(~chained):
+            self.final[slots[row]] = next_state[row].astype(self.dtypes.next_state)
+
+        self._write([self.storage.state, self.storage.action, self.storage.reward, self.storage.done, self.last],
+                    [state, action, reward, done, ~chained])
+        self._advance(num)
+
+    def _fetch(self, indices):
+        if self.storage is None:
+            return super()._fetch(indices)
+        state = self.storage.state
+        next_state = state[(indices + 1) % self.capacity]
+        for row in np.flatnonzero(self.last[indices]):
+            next_state[row] = self.final[indices[row]]
+        return Transition(state[indices], self.storage.action[indices], next_state, self.storage.reward[indices],
+                          self.storage.done[indices])
+
+    def _segment(self, start, stop):
+        return self._fetch(np.arange(start, stop))
+
+    def shuffle(self):
+        """Shuffles whole chains of transitions so that they keep sharing their observations"""
+        if self.size == 0:
+            return
+        order = self._latest_indices(self.size)
+        batch = self._fetch(order)
+        runs = np.split(np.arange(self.size), np.flatnonzero(self.last[order])[:-1] + 1)
+        permutation = np.concatenate([runs[i] for i in np.random.permutation(len(runs))])
+        self.reset()
+        self.extend(*[field[permutation] for field in batch])
+
+    def reset(self):
+        super().reset()
+        self.last[:] = False
+        self.final = {}
+
+
+class ReplayView(object):
+    """
+    Replay buffer of an individual that keeps the insertion numbers of its transitions in a shared
+    ReplayMemory instead of copies of them. References to slots that the shared ring has since
+    overwritten are dropped on access.
+    """
+
+    def __init__(self, memory: ReplayMemory, capacity):
+        self.memory = memory
+        self.device = memory.device
+        self.capacity = capacity
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.position = 0
+        self.size = 0
+
+    def _push(self, ids):
+        num = len(ids)
+        if num > self.capacity:
+            ids = ids[-self.capacity:]
+            self.position = (self.position + num - self.capacity) % self.capacity
+            num = self.capacity
+
+        first = min(num, self.capacity - self.position)
+        self.ids[self.position:self.position + first] = ids[:first]
+        self.ids[:num - first] = ids[first:]
+        self.position = (self.position + num) % self.capacity
+        self.size = min(self.size + num, self.capacity)
+
+    def add(self, *args):
+        """References the most recent transition of the shared memory, which the caller has just saved there"""
+        self._push(np.array([self.memory.total - 1]))
+
+    def extend(self, *args):
+        """References the most recent block of transitions of the shared memory"""
+        num = len(args[0])
+        self._push(np.arange(self.memory.total - num, self.memory.total))
+
+    def _prune(self):
+        """Drops the references to transitions evicted from the shared memory, keeping the order"""
+        if self.size == 0:
+            return
+        ids = self.latest_ids(self.size, prune=False)
+        valid = ids >= self.memory.total - self.memory.capacity
+        if not valid.all():
+            self.reset()
+            self._push(ids[valid])
+
+    def latest_ids(self, latest, prune=True):
+        """
+        Returns the insertion numbers of the latest elements, ordered from the oldest to the most recent one
+        :param latest: the number of latest elements
+        """
+        if prune:
+            self._prune()
+        latest = min(latest, self.size)
+        return self.ids[(self.position - latest + np.arange(latest)) % self.capacity]
+
+    def copy_from(self, other, latest):
+        """
+        References the latest elements of another view on the same shared memory
+        :param other: another replay view
+        :param latest: the number of elements to copy
+        """
+        self._push(other.latest_ids(latest))
+
+    def add_content_of(self, other):
+        self.copy_from(other, self.capacity)
+
+    def add_latest_from(self, other, latest):
+        self.copy_from(other, latest)
+
+    def get_latest(self, latest):
+        return self.memory._fetch(self.latest_ids(latest) % self.memory.capacity)
+
+    def shuffle(self):
+        ids = self.latest_ids(self.size)
+        self.reset()
+        self._push(np.random.permutation(ids))
+
+    def sample(self, batch_size):
+        return self.sample_from_latest(batch_size, self.capacity)
+
+    def sample_from_latest(self, batch_size, latest):
+        ids = self.latest_ids(latest)
+        indices = ids[np.random.randint(0, len(ids), size=batch_size)]
+        return self.memory._gather(indices % self.memory.capacity)
 
     def __len__(self):
-        return len(self.memory)
+        self._prune()
+        return self.size
 
     def reset(self):
-        self.memory = []
         self.position = 0
+        self.size = 0
+
+    def materialize(self):
+        """Returns a standalone ReplayMemory holding a copy of the referenced transitions"""
+        memory = ReplayMemory(self.capacity, self.device, self.memory.dtypes.state)
+        memory.extend(*self.get_latest(self.capacity))
+        return memory
+
+    def save(self, path, compressed=True):
+        self.materialize().save(path, compressed)
 
 
-class PrioritizedReplayMemory(object):
-    def __init__(self, capacity, device, alpha=0.6, beta_start=0.4, beta_frames=100000):
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    ReplayMemory that samples transitions proportionally to their priority. The priorities are kept in
+    sum and min segment trees indexed by slot.
+    """
+
+    def __init__(self, capacity, device, alpha=0.6, beta_start=0.4, beta_frames=100000, obs_dtype=np.float32):
+        super().__init__(capacity, device, obs_dtype)
         self.prob_alpha = alpha
-        self.capacity = capacity
-        self.buffer = []
-        self.pos = 0
-        self.priorities = np.zeros((capacity,), dtype=np.float32)
+        self.sum_tree = SumSegmentTree(capacity)
+        self.min_tree = MinSegmentTree(capacity)
+        self.max_priority = 1.0 ** self.prob_alpha  # Largest priority seen so far, given to new transitions
         self.frame = 1
         self.beta_start = beta_start
         self.beta_frames = beta_frames
-        self.device = device
 
     def beta_by_frame(self, frame_idx):
         return min(1.0, self.beta_start + frame_idx * (1.0 - self.beta_start) / self.beta_frames)
 
-    def push(self, transition: Transition):
-        max_prio = self.priorities.max() if self.buffer else 1.0 ** self.prob_alpha
-
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(transition)
-        else:
-            self.buffer[self.pos] = transition
+    def _set_priorities(self, indices, priorities):
+        self.sum_tree.update(indices, priorities)
+        self.min_tree.update(indices, priorities)
 
-        self.priorities[self.pos] = max_prio
+    def add(self, *args):
+        slot = self.position
+        super().add(*args)
+        self._set_priorities([slot], self.max_priority)
 
-        self.pos = (self.pos + 1) % self.capacity
+    def extend(self, *args):
+        start = self.total
+        super().extend(*args)
+        slots = np.arange(max(start, self.total - self.capacity), self.total) % self.capacity
+        self._set_priorities(slots, self.max_priority)
 
     def sample(self, batch_size):
-        if len(self.buffer) == self.capacity:
-            prios = self.priorities
-        else:
-            prios = self.priorities[:self.pos]
-
-        total = len(self.buffer)
-
-        probs = prios / prios.sum()
+        """
+        Samples a prioritised minibatch
+        :return: the batch tensors, the sampled slots and the importance sampling weights
+        """
+        total = len(self)
 
-        indices = np.random.choice(total, batch_size, p=probs)
-        samples = [self.buffer[idx] for idx in indices]
+        # Stratified sampling, one prefix sum drawn uniformly from each of batch_size equal segments
+        prio_sum = self.sum_tree.sum()
+        prefixsums = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (prio_sum / batch_size)
+        indices = np.minimum(self.sum_tree.find_prefixsum_index(prefixsums), total - 1)
 
         beta = self.beta_by_frame(self.frame)
         self.frame += 1
 
         # min of ALL probs, not just sampled probs
-        prob_min = probs.min()
+        prob_min = self.min_tree.min() / prio_sum
         max_weight = (prob_min * total) ** (-beta)
 
-        weights = (total * probs[indices]) ** (-beta)
+        probs = self.sum_tree[indices] / prio_sum
+        weights = (total * probs) ** (-beta)
         weights /= max_weight
         weights = torch.tensor(weights, device=self.device, dtype=torch.float)
 
-        return samples, indices, weights
+        return self._gather(indices), indices, weights
 
     def update_priorities(self, batch_indices, batch_priorities):
-        for idx, prio in zip(batch_indices, batch_priorities):
-            self.priorities[idx] = (prio + 1e-5) ** self.prob_alpha
+        priorities = (np.asarray(batch_priorities, dtype=np.float64).reshape(-1) + 1e-5) ** self.prob_alpha
+        self._set_priorities(batch_indices, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
 
-    def __len__(self):
-        return len(self.buffer)
+    def reset(self):
+        super().reset()
+        self.sum_tree = SumSegmentTree(self.capacity)
+        self.min_tree = MinSegmentTree(self.capacity)
+        self.max_priority = 1.0 ** self.prob_alpha
 
+
+class EpisodeStaging(object):
+    """
+    Preallocated arrays where an episode is collected step by step before being inserted in bulk
+    into the replay buffers with extend. The arrays are allocated on the first transition.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.storage = None
+        self.size = 0
+
+    def add(self, *args):
+        if self.storage is None:
+            self.storage = Transition(*[np.zeros((self.capacity,) + np.shape(arg), dtype=np.float32) for arg in args])
+        for field, arg in zip(self.storage, args):
+            field[self.size] = arg
+        self.size += 1
+
+    def full(self):
+        return self.size == self.capacity
+
+    def flush(self, *buffers):
+        """
+        Inserts the staged transitions in each buffer, in order, and empties the staging arrays
+        :param buffers: the buffers to extend, a shared buffer must come before the views on it
+        """
+        if self.size == 0:
+            return
+        block = [field[:self.size] for field in self.storage]
+        for buffer in buffers:
+            buffer.extend(*block)
+        self.size = 0
+
+
+def convert_legacy_buffer(source, target, compressed=True):
+    """
+    Converts a pickled buffer (a list of Transitions, as saved by -save_periodic before the snapshot format)
+    into a snapshot file that ReplayMemory.load reads
+    :param source: the .pkl file
+    :param target: the .npz file to write
+    """
+    with open(source, 'rb') as f:
+        legacy = pickle.load(f)
+
+    if hasattr(legacy, 'memory'):
+        # Oldest transition first, as get_latest returns them
+        transitions = legacy.memory
+        if len(transitions) == legacy.capacity:
+            transitions = transitions[legacy.position:] + transitions[:legacy.position]
+        memory = ReplayMemory(legacy.capacity, 'cpu')
+        if transitions:
+            memory.extend(*[np.concatenate(field) for field in zip(*transitions)])
+    else:
+        memory = legacy
+    memory.save(target, compressed)
@@ -0,0 +1,170 @@
+import copy
+import multiprocessing as mp
+import numpy as np
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from core.ddpg import Actor
+from core.replay_memory import Transition
+
+
+def episode_limit(env, default=1000):
+    """Returns the maximum length of an episode of env, as registered in gym"""
+    spec = getattr(env, 'spec', None)
+    return getattr(spec, 'max_episode_steps', None) or default
+
+
+class EpisodeArrays:
+    """Shared memory arrays holding the transitions of one episode"""
+
+    def __init__(self, max_steps, state_dim, action_dim):
+        self.tensors = Transition(torch.zeros(max_steps, state_dim).share_memory_(),
+                                  torch.zeros(max_steps, action_dim).share_memory_(),
+                                  torch.zeros(max_steps, state_dim).share_memory_(),
+                                  torch.zeros(max_steps, dtype=torch.float64).share_memory_(),
+                                  torch.zeros(max_steps).share_memory_())
+
+    def arrays(self):
+        return Transition(*[tensor.numpy() for tensor in self.tensors])
+
+
+def _rollout_worker(index, args, make_env, weights, episode, tasks, results):
+    torch.set_num_threads(1)
+    env = make_env()
+    actor = Actor(args)
+    arrays = episode.arrays()
+    loaded = None
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        slot, version, seed, store_transition = task
+        try:
+            # The weights only travel through shared memory, the task carries their version
+            if loaded != (slot, version):
+                loaded = None
+                vector_to_parameters(weights[slot], actor.parameters())
+                policy = actor.numpy_policy()
+                loaded = (slot, version)
+
+            env.seed(seed)
+            state = env.reset()
+            total_reward = 0.0
+            steps = 0
+            done = False
+            while not done:
+                action = policy.select_action(state)
+                next_state, reward, done, info = env.step(action.flatten())
+                total_reward += reward
+                if store_transition:
+                    if steps == len(arrays.reward):
+                        raise RuntimeError('Episode longer than the {} steps of the rollout arrays'.format(steps))
+                    arrays.state[steps] = state
+                    arrays.action[steps] = action
+                    arrays.next_state[steps] = next_state
+                    arrays.reward[steps] = reward
+                    arrays.done[steps] = float(done)
+                steps += 1
+                state = next_state
+            results.put((index, (total_reward, steps)))
+        except Exception as e:
+            results.put((index, e))
+
+
+class RolloutPool:
+    """
+    A pool of long-lived worker processes, each owning its own environment. The actors are published as
+    flat vectors in a shared memory matrix, one row per slot, and tasks only carry the slot, its version and
+    the episode seed. Each worker writes the transitions of its episode in its own shared memory arrays.
+
+    Every episode is seeded with args.seed plus its index, so the results do not depend on which worker
+    played it.
+    """
+
+    def __init__(self, args, make_env, num_workers, num_slots, max_steps):
+        self.args = args
+        self.worker_args = copy.copy(args)
+        self.worker_args.device = torch.device('cpu')
+        self.num_slots = num_slots
+        self.num_params = parameters_to_vector(Actor(self.worker_args).parameters()).numel()
+        self.weights = torch.zeros(num_slots, self.num_params).share_memory_()
+        self.versions = np.zeros(num_slots, dtype=np.int64)
+        self.episode_count = 0
+
+        # Fork so that the environment factory does not need to be picklable
+        context = mp.get_context('fork')
+        self.episodes = [EpisodeArrays(max_steps, args.state_dim, args.action_dim) for _ in range(num_workers)]
+        self.tasks = [context.Queue() for _ in range(num_workers)]
+        self.results = context.Queue()
+        self.workers = []
+        for i in range(num_workers):
+            worker = context.Process(target=_rollout_worker, daemon=True,
+                                     args=(i, self.worker_args, make_env, self.weights, self.episodes[i],
+                                           self.tasks[i], self.results))
+            worker.start()
+            self.workers.append(worker)
+
+    def publish(self, agents):
+        """Writes the actors of the agents in the first slots and bumps their versions"""
+        with torch.no_grad():
+            for slot, agent in enumerate(agents):
+                self.weights[slot].copy_(parameters_to_vector(agent.actor.parameters()))
+                self.versions[slot] += 1
+
+    def evaluate(self, agents, num_evals, store_transition=True):
+        """
+        Plays num_evals episodes with every agent on the workers
+        :param agents: the list of agents to evaluate
+        :param num_evals: the number of episodes per agent
+        :param store_transition: whether to collect the transitions of the episodes
+        :return: a list with, for each episode, the agent index, the reward and the transitions (or None)
+        """
+        if len(agents) > self.num_slots:
+            episodes = []
+            for start in range(0, len(agents), self.num_slots):
+                for episode in self.evaluate(agents[start:start + self.num_slots], num_evals, store_transition):
+                    episode['index'] += start
+                    episodes.append(episode)
+            return episodes
+
+        self.publish(agents)
+        owners = np.repeat(np.arange(len(agents)), num_evals)
+        seeds = self.args.seed + self.episode_count + 1 + np.arange(len(owners))
+        self.episode_count += len(owners)
+
+        episodes = [None] * len(owners)
+        running = {}
+        pending = list(range(len(owners)))[::-1]
+        free = list(range(len(self.workers)))[::-1]
+        error = None
+        while pending or running:
+            while pending and free:
+                i, worker = pending.pop(), free.pop()
+                slot = owners[i]
+                self.tasks[worker].put((slot, self.versions[slot], int(seeds[i]), store_transition))
+                running[worker] = i
+
+            worker, result = self.results.get()
+            i = running.pop(worker)
+            if isinstance(result, Exception):
+                # No episode is started anymore, the ones in flight are collected so that their results do not
+                # reach the next call
+                error = error or result
+                pending = []
+            elif error is None:
+                reward, steps = result
+                # Copied out before the worker gets its next episode
+                transitions = Transition(*[field[:steps].copy() for field in self.episodes[worker].arrays()]) \
+                    if store_transition else None
+                episodes[i] = {'index': owners[i], 'reward': reward, 'transitions': transitions}
+            free.append(worker)
+
+        if error is not None:
+            raise error
+        return episodes
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,66 @@
+import numpy as np
+
+# Array-backed segment trees for prioritised experience replay. Node 1 is the root, node i has children
+# 2i and 2i + 1 and the leaves live in [size, 2 * size). All the operations work on batches of leaves.
+
+
+class SegmentTree(object):
+    def __init__(self, capacity, operation, neutral_element):
+        self.capacity = capacity
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.depth = int(np.log2(self.size))
+        self.operation = operation
+        self.tree = np.full(2 * self.size, neutral_element, dtype=np.float64)
+
+    def update(self, indices, values):
+        """
+        Sets the values of a batch of leaves and recomputes their ancestors level by level
+        :param indices: the leaf indices
+        :param values: the new values, one per index
+        """
+        nodes = np.asarray(indices, dtype=np.int64) + self.size
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+    def reduce(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.size]
+
+
+class SumSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, 0.0)
+
+    def sum(self):
+        return self.reduce()
+
+    def find_prefixsum_index(self, prefixsums):
+        """
+        Finds, for each prefix sum, the highest leaf i such that sum(leaves[:i]) <= prefixsum
+        :param prefixsums: array of prefix sums in [0, sum())
+        :return: the leaf indices
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(len(prefixsums), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            go_right = prefixsums > left_sum
+            prefixsums -= left_sum * go_right
+            nodes = left + go_right
+        # Rounding can push a prefix sum past the last non empty leaf
+        return np.minimum(nodes - self.size, self.capacity - 1)
+
+
+class MinSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.minimum, np.inf)
+
+    def min(self):
+        return self.reduce()
@@ -51,9 +51,25 @@ class Parameters:
         self.tau = 0.001
         self.seed = cla.seed
         self.batch_size = 128
+        self.batches_per_draw = 256  # Minibatches gathered at once by train_ddpg, bounds the gather memory
+        self.prefetch = cla.prefetch
+        self.prefetch_queue = cla.prefetch_queue
         self.frac_frames_train = 1.0
+        if cla.utd_ratio is not None:
+            self.frac_frames_train = cla.utd_ratio
+        self.async_learner = cla.async_learner
+
+        # Test episodes of the champion and the RL agent
+        self.test_every = cla.test_every
+        self.eval_service = cla.eval_service
         self.use_done_mask = True
         self.buffer_size = 1000000
+        self.staging_size = 1000  # Transitions of an episode collected by evaluate before a bulk insert
+        self.obs_dtype = cla.obs_dtype
+        self.dedup_obs = cla.dedup_obs
+        self.memmap_buffer = cla.memmap_buffer
+        self.memmap_cache = cla.memmap_cache
+        self.torch_buffer = cla.torch_buffer
         self.ls = 128
 
         # Prioritised Experience Replay
@@ -73,6 +89,12 @@ class Parameters:
             self.num_evals = 5
         else:
             self.num_evals = 1
+        self.lockstep_eval = cla.lockstep_eval
+        self.rollout_workers = cla.rollout_workers
+        self.racing = cla.racing
+        self.race_z = 2.0  # Width of the racing confidence bounds in standard errors
+        self.fitness_cache = cla.fitness_cache
+        self.cache_fresh_evals = cla.cache_fresh_evals
 
         # Elitism Rate
         if cla.env == 'Reacher-v2' or cla.env == 'Walker2d-v2' or cla.env == 'Ant-v2' or cla.env == 'Hopper-v2':
@@ -82,6 +104,7 @@ class Parameters:
 
         # Number of actors in the population
         self.pop_size = 10
+        self.flat_population = cla.flat_population
 
         # Mutation and crossover
         self.crossover_prob = 0.0
@@ -97,6 +120,7 @@ class Parameters:
 
         # Genetic memory size
         self.individual_bs = 8000
+        self.buffer_views = cla.buffer_views
 
         # Variation operator statistics
         self.opstat = cla.opstat
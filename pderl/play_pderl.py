@@ -17,6 +17,7 @@ args = parser.parse_args()
 
 def evaluate(agent, env, trials=1, render=False):
     results = []
+    policy = agent.actor.numpy_policy()
     for trial in range(trials):
         total_reward = 0
 
@@ -24,7 +25,7 @@ def evaluate(agent, env, trials=1, render=False):
         done = False
         while not done:
             if render: env.render()
-            action = agent.actor.select_action(np.array(state))
+            action = policy.select_action(state)
 
             # Simulate one step in environment
             next_state, reward, done, info = env.step(action.flatten())
@@ -49,6 +50,8 @@ if __name__ == "__main__":
 
     parameters = Parameters(None, init=False)
     parameters.individual_bs = 0
+    parameters.obs_dtype = 'float32'
+    parameters.dedup_obs = False
     parameters.action_dim = env.action_space.shape[0]
     parameters.state_dim = env.observation_space.shape[0]
     parameters.use_ln = True
@@ -3,7 +3,6 @@ from core import mod_utils as utils, agent
 from core.tensorboard_tracker import TensorBoardTracker, LegacyCSVTracker
 import gym, torch
 import argparse
-import pickle
 from core.operator_runner import OperatorRunner
 from parameters import Parameters
 
@@ -20,6 +19,38 @@ parser.add_argument('-distil', help='Use distilation crossover', action='store_t
 parser.add_argument('-distil_type', help='Use distilation crossover. Choices: (fitness) (distance)',
                     type=str, default='fitness')
 parser.add_argument('-per', help='Use Prioritised Experience Replay', action='store_true')
+parser.add_argument('-obs_dtype', help='Storage type of the replay observations. Choices: (float32) (float16)',
+                    type=str, default='float32', choices=['float32', 'float16'])
+parser.add_argument('-dedup_obs', help='Store each observation once in the replay buffers', action='store_true')
+parser.add_argument('-memmap_buffer', help='Keep the replay buffer in memory-mapped files in the logdir',
+                    action='store_true')
+parser.add_argument('-memmap_cache', help='Page cache budget (MB) of the memory-mapped replay buffer', type=int,
+                    default=1024)
+parser.add_argument('-torch_buffer', help='Keep the replay buffer as tensors on the training device',
+                    action='store_true')
+parser.add_argument('-prefetch', help='Sample the DDPG minibatches in a background thread (not used with -per)',
+                    action='store_true')
+parser.add_argument('-prefetch_queue', help='Number of minibatches kept ready by the prefetcher', type=int, default=8)
+parser.add_argument('-async_learner', help='Run the DDPG updates in a thread during the rollouts (not used with -per)',
+                    action='store_true')
+parser.add_argument('-utd_ratio', help='DDPG updates per stored frame (frac_frames_train)', type=float)
+parser.add_argument('-test_every', help='Generations between the test episodes of the champion and RL agent', type=int,
+                    default=1)
+parser.add_argument('-eval_service', help='Play the test episodes in a separate process and log them when done',
+                    action='store_true')
+parser.add_argument('-buffer_views', help='Individual buffers reference the shared replay buffer instead of copying it',
+                    action='store_true')
+parser.add_argument('-flat_population', help='Keep the actor parameters of the population in one contiguous tensor',
+                    action='store_true')
+parser.add_argument('-lockstep_eval', help='Evaluate the population in lockstep on one environment copy per episode',
+                    action='store_true')
+parser.add_argument('-rollout_workers', help='Number of worker processes playing the evaluation episodes', type=int,
+                    default=0)
+parser.add_argument('-racing', help='Stop evaluating individuals that cannot reach a selected rank', action='store_true')
+parser.add_argument('-fitness_cache', help='Reuse the episode returns of individuals with unchanged weights',
+                    action='store_true')
+parser.add_argument('-cache_fresh_evals', help='Fresh episodes played by individuals found in the fitness cache',
+                    type=int, default=1)
 parser.add_argument('-mut_mag', help='The magnitude of the mutation', type=float, default=0.05)
 parser.add_argument('-mut_noise', help='Use a random mutation magnitude', action='store_true')
 parser.add_argument('-verbose_mut', help='Make mutations verbose', action='store_true')
@@ -84,9 +115,23 @@ if __name__ == "__main__":
         exit()
 
     # Create Agent
-    agent = agent.Agent(parameters, env)
+    agent = agent.Agent(parameters, env, lambda: utils.NormalizedActions(gym.make(parameters.env_name)))
     print('Running', parameters.env_name, ' State_dim:', parameters.state_dim, ' Action_dim:', parameters.action_dim)
 
+    def log_test_results(results):
+        # Test scores played by the evaluation service, logged at the frame count of their snapshot
+        for result in results:
+            print('Test_Score:', '%.2f' % result['test_score'], ' DDPG Reward:', '%.2f' % result['ddpg_reward'],
+                  ' at #Frames:', result['frames'], ' (generation %d)' % result['generation'])
+            if tb_tracker:
+                tb_tracker.log_performance(step=result['frames'], erl_score=result['test_score'],
+                                           ddpg_reward=result['ddpg_reward'])
+            if tracker:
+                tracker.update([result['test_score']], result['games'])
+                frame_tracker.update([result['test_score']], result['frames'])
+                time_tracker.update([result['test_score']], result['time'] - time_start)
+                ddpg_tracker.update([result['ddpg_reward']], result['frames'])
+
     next_save = parameters.next_save; time_start = time.time()
     while agent.num_frames <= parameters.num_frames:
         stats = agent.train()
@@ -110,8 +155,14 @@ if __name__ == "__main__":
               ' Test_Score:','%.2f'%erl_score if erl_score is not None else None,
               ' Avg:','%.2f'%avg_score,
               ' ENV:  '+ parameters.env_name,
-              ' DDPG Reward:', '%.2f'%ddpg_reward,
+              ' DDPG Reward:', '%.2f'%ddpg_reward if ddpg_reward is not None else None,
               ' PG Loss:', '%.4f' % policy_gradient_loss)
+        if parameters.prefetch:
+            print('Prefetch starved:', agent.prefetch_starved, ' Prefetch full:', agent.prefetch_full)
+        if parameters.racing:
+            print('Racing frames saved:', '%.0f' % stats['race_frames_saved'])
+        if parameters.fitness_cache:
+            print('Fitness cache frames saved:', '%.0f' % stats['cache_frames_saved'])
         print()
         
         # TensorBoard logging
@@ -144,6 +195,15 @@ if __name__ == "__main__":
             current_time = time.time() - time_start
             tb_tracker.log_custom_metric('Time_Elapsed_Hours', current_time/3600, agent.num_frames, 'Training')
             tb_tracker.log_custom_metric('Games_Completed', agent.num_games, agent.num_frames, 'Training')
+            if parameters.prefetch:
+                tb_tracker.log_custom_metric('Prefetch_Starved', agent.prefetch_starved, agent.num_frames, 'Training')
+                tb_tracker.log_custom_metric('Prefetch_Full', agent.prefetch_full, agent.num_frames, 'Training')
+            if parameters.racing:
+                tb_tracker.log_custom_metric('Race_Frames_Saved', stats['race_frames_saved'], agent.num_frames,
+                                             'Training')
+            if parameters.fitness_cache:
+                tb_tracker.log_custom_metric('Cache_Frames_Saved', stats['cache_frames_saved'], agent.num_frames,
+                                             'Training')
             
             # Periodically log network weights (optional)
             if parameters.log_weights and agent.num_games % parameters.log_freq == 0:
@@ -156,11 +216,15 @@ if __name__ == "__main__":
         
         # CSV logging (backward compatibility)
         if tracker:
-            tracker.update([erl_score], agent.num_games)
-            frame_tracker.update([erl_score], agent.num_frames)
-            time_tracker.update([erl_score], time.time()-time_start)
-            ddpg_tracker.update([ddpg_reward], agent.num_frames)
+            # No test scores in the generations skipped by -test_every or sent to the evaluation service
+            if erl_score is not None:
+                tracker.update([erl_score], agent.num_games)
+                frame_tracker.update([erl_score], agent.num_frames)
+                time_tracker.update([erl_score], time.time()-time_start)
+            if ddpg_reward is not None:
+                ddpg_tracker.update([ddpg_reward], agent.num_frames)
             selection_tracker.update([elite, selected, discarded], agent.num_frames)
+        log_test_results(stats['test_results'])
 
         # Save Policy
         if agent.num_games > next_save:
@@ -176,16 +240,25 @@ if __name__ == "__main__":
 
                     actor_save_name = os.path.join(save_folder, 'evo_net_actor_{}.pkl'.format(next_save))
                     critic_save_name = os.path.join(save_folder, 'evo_net_critic_{}.pkl'.format(next_save))
-                    buffer_save_name = os.path.join(save_folder, 'champion_buffer_{}.pkl'.format(next_save))
+                    buffer_save_name = os.path.join(save_folder, 'champion_buffer_{}.npz'.format(next_save))
 
                     torch.save(agent.pop[elite_index].actor.state_dict(), actor_save_name)
                     torch.save(agent.rl_agent.critic.state_dict(), critic_save_name)
-                    with open(buffer_save_name, 'wb+') as buffer_file:
-                        pickle.dump(agent.rl_agent.buffer, buffer_file)
+                    agent.rl_agent.buffer.save(buffer_save_name)
 
+            if parameters.memmap_buffer:
+                agent.replay_buffer.flush()
             print("Progress Saved")
     
     # Training completion cleanup
+    if parameters.memmap_buffer:
+        agent.replay_buffer.flush()
+    if parameters.rollout_workers > 0:
+        agent.pop_evaluator.close()
+    if parameters.async_learner:
+        agent.learner.close()
+    if parameters.eval_service:
+        log_test_results(agent.eval_service.close())
     if tb_tracker:
         # Log final statistics
         total_time = time.time() - time_start
@@ -0,0 +1,47 @@
+import os
+import random
+import sys
+import fastrand
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parameters import Parameters
+
+
+@pytest.fixture
+def make_args(tmp_path):
+    """Factory of the Parameters needed to build actors and SSNE, without parsing the command line"""
+    def make_args(state_dim=11, action_dim=3, use_ln=True, seed=7):
+        args = Parameters(None, init=False)
+        args.state_dim, args.action_dim, args.ls, args.use_ln = state_dim, action_dim, 128, use_ln
+        args.device, args.seed = torch.device('cpu'), seed
+        args.pop_size, args.elite_fraction, args.opstat, args.opstat_freq = 10, 0.2, False, 1
+        args.save_foldername = str(tmp_path)
+        return args
+    return make_args
+
+
+def seed_all(seed):
+    """Seeds the generators of the operators, fastrand included, so that the statistical tests are reproducible"""
+    random.seed(seed)
+    np.random.seed(seed)
+    fastrand.pcg32_seed(seed)
+    torch.manual_seed(seed)
+
+
+class Gene:
+    """Stand-in for GeneticAgent with only an actor, enough for the SSNE operators"""
+
+    def __init__(self, actor):
+        self.actor = actor
+
+
+def randomize(actor, generator=None):
+    """Draws every parameter, the layer norm gains and biases included, so that no row starts equal"""
+    with torch.no_grad():
+        for param in actor.parameters():
+            param.copy_(torch.randn(param.shape, generator=generator) * 0.5)
+    return actor
@@ -0,0 +1,97 @@
+import pytest
+import torch
+from scipy import stats
+from benchmark import scalar_crossover
+from core.ddpg import Actor
+from core.mod_neuro_evo import SSNE
+from conftest import Gene, randomize, seed_all
+
+TRIALS = 300
+P_VALUE = 1e-3
+
+
+def sequential_masks(generator, batch, num_rows, max_crossovers):
+    """Replays the draws of SSNE.crossover_masks as the original sequence of row copies"""
+    num_cross_overs = torch.randint(max_crossovers, (batch, 1), generator=generator)
+    rows = torch.randint(num_rows, (batch, max_crossovers), generator=generator)
+    to_gene1 = torch.rand(batch, max_crossovers, generator=generator) < 0.5
+    masks = torch.zeros(2, batch, num_rows, dtype=torch.bool)
+    for b in range(batch):
+        W1, W2 = list(range(num_rows)), list(range(num_rows, 2 * num_rows))
+        for k in range(num_cross_overs[b, 0]):
+            row = rows[b, k]
+            if to_gene1[b, k]:
+                W1[row] = W2[row]
+            else:
+                W2[row] = W1[row]
+        masks[0, b] = torch.tensor([W1[row] != row for row in range(num_rows)])
+        masks[1, b] = torch.tensor([W2[row] != num_rows + row for row in range(num_rows)])
+    return masks
+
+
+@pytest.mark.parametrize('num_rows, max_crossovers', [(1, 1), (5, 10), (5, 5), (128, 256)])
+def test_crossover_masks_match_sequential_copies(make_args, num_rows, max_crossovers):
+    ssne = SSNE(make_args(), None, None)
+    replay = torch.Generator()
+    replay.set_state(ssne.generator.get_state())
+    to_gene1, to_gene2 = ssne.crossover_masks(50, num_rows, max_crossovers)
+    expected = sequential_masks(replay, 50, num_rows, max_crossovers)
+    assert torch.equal(to_gene1, expected[0])
+    assert torch.equal(to_gene2, expected[1])
+
+
+def swap_fractions(crossover, genes, sources, trials):
+    """Per parameter and trial, the fraction of the rows of each child that comes from the other parent"""
+    fractions = {}
+    for _ in range(trials):
+        for gene, source in zip(genes, sources):
+            gene.actor.load_state_dict(source)
+        crossover(genes)
+        for i in range(0, len(genes), 2):
+            for key, value1 in genes[i].actor.state_dict().items():
+                value2 = genes[i + 1].actor.state_dict()[key]
+                from2 = (value1 == sources[i + 1][key]).view(len(value1), -1).all(1)
+                from1 = (value2 == sources[i][key]).view(len(value2), -1).all(1)
+                fractions.setdefault(key, ([], []))
+                fractions[key][0].append(from2.float().mean().item())
+                fractions[key][1].append(from1.float().mean().item())
+    return fractions
+
+
+def test_crossover_batch_matches_scalar_statistics(make_args):
+    seed_all(0)
+    args = make_args()
+    ssne = SSNE(args, None, None)
+    # Every parameter is drawn so that no row is equal in the two parents, the layer norms included
+    genes = [Gene(randomize(Actor(args))) for _ in range(4)]
+
+    def loop(genes):
+        for gene1, gene2 in zip(genes[0::2], genes[1::2]):
+            scalar_crossover(gene1.actor, gene2.actor)
+
+    def batched(genes):
+        ssne.crossover_batch(list(zip(genes[0::2], genes[1::2])))
+
+    sources = [{key: value.clone() for key, value in gene.actor.state_dict().items()} for gene in genes]
+    scalar = swap_fractions(loop, genes, sources, TRIALS)
+    batched = swap_fractions(batched, genes, sources, TRIALS)
+
+    assert scalar.keys() == batched.keys()
+    for key in scalar:
+        for direction in range(2):
+            assert stats.ks_2samp(scalar[key][direction], batched[key][direction]).pvalue > P_VALUE, key
+
+
+def test_crossover_inplace_keeps_rows(make_args):
+    seed_all(0)
+    args = make_args()
+    ssne = SSNE(args, None, None)
+    gene1, gene2 = Gene(randomize(Actor(args))), Gene(randomize(Actor(args)))
+    sources = [{key: value.clone() for key, value in gene.actor.state_dict().items()} for gene in (gene1, gene2)]
+    ssne.crossover_inplace(gene1, gene2)
+    # Every row of a child is the same row of one of the parents
+    for gene in (gene1, gene2):
+        for key, value in gene.actor.state_dict().items():
+            rows1 = (value == sources[0][key]).view(len(value), -1).all(1)
+            rows2 = (value == sources[1][key]).view(len(value), -1).all(1)
+            assert torch.all(rows1 | rows2), key
@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+from scipy import stats
+from benchmark import scalar_mutate
+from core.ddpg import Actor
+from core.mod_neuro_evo import SSNE
+from core.mod_utils import is_lnorm_key
+from conftest import Gene, seed_all
+
+TRIALS = 200
+SAMPLES_PER_TRIAL = 20  # Relative changes kept per trial and layer, the changes of one trial are not independent
+P_VALUE = 1e-3
+
+
+def mutation_samples(mutate, actor, trials):
+    """
+    Per weight matrix: the fraction of changed weights of every trial, a sample of the relative changes, and
+    the number of changes larger than the weight (super mutations and resets) out of all the changes
+    """
+    source = {key: value.clone() for key, value in actor.state_dict().items()}
+    rng = np.random.RandomState(0)
+    samples = {}
+    for _ in range(trials):
+        actor.load_state_dict(source)
+        mutate(actor)
+        for key, value in actor.state_dict().items():
+            if is_lnorm_key(key) or len(value.shape) != 2:
+                continue
+            changed = value != source[key]
+            relative = ((value - source[key]) / source[key])[changed].abs().numpy()
+            fractions, changes, large = samples.setdefault(key, ([], [], [0, 0]))
+            fractions.append(changed.float().mean().item())
+            changes.extend(rng.permutation(relative)[:SAMPLES_PER_TRIAL])
+            large[0] += int(np.sum(relative > 1)); large[1] += len(relative)
+    return samples
+
+
+def two_proportion_z(count1, total1, count2, total2):
+    pooled = (count1 + count2) / (total1 + total2)
+    return (count1 / total1 - count2 / total2) / np.sqrt(pooled * (1 - pooled) * (1 / total1 + 1 / total2))
+
+
+def test_mutate_inplace_matches_scalar_statistics(make_args):
+    seed_all(0)
+    args = make_args()
+    ssne = SSNE(args, None, None)
+    gene = Gene(Actor(args))
+
+    scalar = mutation_samples(scalar_mutate, gene.actor, TRIALS)
+    tensorized = mutation_samples(lambda actor: ssne.mutate_inplace(gene), gene.actor, TRIALS)
+
+    assert scalar.keys() == tensorized.keys()
+    for key in scalar:
+        fractions1, changes1, large1 = scalar[key]
+        fractions2, changes2, large2 = tensorized[key]
+        assert stats.ks_2samp(fractions1, fractions2).pvalue > P_VALUE, key + ': changed fractions differ'
+        assert stats.ks_2samp(changes1, changes2).pvalue > P_VALUE, key + ': relative changes differ'
+        z = two_proportion_z(large1[0], large1[1], large2[0], large2[1])
+        assert abs(z) < stats.norm.isf(P_VALUE / 2), key + ': share of super mutations and resets differs'
+
+
+def test_mutate_inplace_spares_layer_norm_and_biases(make_args):
+    seed_all(0)
+    args = make_args()
+    ssne = SSNE(args, None, None)
+    gene = Gene(Actor(args))
+    source = {key: value.clone() for key, value in gene.actor.state_dict().items()}
+    for _ in range(20):
+        ssne.mutate_inplace(gene)
+    for key, value in gene.actor.state_dict().items():
+        if is_lnorm_key(key) or len(value.shape) != 2:
+            assert torch.equal(value, source[key]), key
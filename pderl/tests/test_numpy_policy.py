@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import torch
+from core.ddpg import Actor
+from conftest import randomize
+
+
+@pytest.mark.parametrize('use_ln', [True, False])
+def test_numpy_policy_matches_actor(make_args, use_ln):
+    torch.manual_seed(0)
+    args = make_args(use_ln=use_ln)
+    actor = randomize(Actor(args))
+    policy = actor.numpy_policy()
+    states = np.random.RandomState(0).randn(200, args.state_dim) * 3
+
+    for state in states:
+        expected = actor.select_action(state)
+        action = policy.select_action(state)
+        assert action.dtype == np.float32
+        np.testing.assert_allclose(action.flatten(), expected, rtol=0, atol=1e-5)
+
+
+def test_numpy_policy_is_a_snapshot(make_args):
+    torch.manual_seed(0)
+    actor = Actor(make_args())
+    policy = actor.numpy_policy()
+    state = np.ones(actor.args.state_dim)
+    before = policy.select_action(state).copy()
+    randomize(actor)
+    np.testing.assert_array_equal(policy.select_action(state), before)
+    assert not np.allclose(actor.numpy_policy().select_action(state).flatten(), before.flatten())
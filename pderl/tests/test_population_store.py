@@ -0,0 +1,71 @@
+import copy
+import numpy as np
+import torch
+from core.ddpg import Actor, flat_layout, flat_parameters, hard_update
+from core.population_eval import stack_actors
+from core.population_store import PopulationStore
+from conftest import randomize
+
+
+def test_store_keeps_the_weights_and_shares_rows(make_args):
+    torch.manual_seed(0)
+    args = make_args()
+    actors = [randomize(Actor(args)) for _ in range(3)]
+    before = [{key: value.clone() for key, value in actor.state_dict().items()} for actor in actors]
+    store = PopulationStore(actors)
+
+    for actor, row, weights in zip(actors, store.weights, before):
+        assert flat_parameters(actor).data_ptr() == row.data_ptr()
+        for key, value in actor.state_dict().items():
+            assert torch.equal(value, weights[key]), key
+    for key, value in store.stacked().items():
+        assert torch.equal(value, stack_actors(actors)[key]), key
+
+    # The extract_parameters vector is the start of the row
+    assert torch.equal(actors[0].extract_parameters(), store.weights[0, :actors[0].count_parameters()])
+
+
+def test_flat_and_loose_actors_agree(make_args):
+    torch.manual_seed(0)
+    args = make_args()
+    loose = [randomize(Actor(args)) for _ in range(2)]
+    flat = [copy.deepcopy(actor) for actor in loose]
+    PopulationStore(flat)
+    assert flat_parameters(loose[0]) is None
+
+    pvec = torch.randn(loose[0].count_parameters())
+    for actors in (loose, flat):
+        actors[1].inject_parameters(pvec)
+        hard_update(actors[0], actors[1])
+    for key, value in loose[0].state_dict().items():
+        assert torch.equal(value, flat[0].state_dict()[key]), key
+
+    # Flat to loose and back goes through the per tensor copy
+    hard_update(loose[1], flat[0])
+    hard_update(flat[1], loose[0])
+    assert torch.equal(flat_parameters(flat[1]), flat_parameters(flat[0]))
+
+
+def test_deep_copy_of_a_stored_actor_is_not_flat(make_args):
+    args = make_args()
+    actor = Actor(args)
+    PopulationStore([actor])
+    clone = copy.deepcopy(actor)
+    assert flat_parameters(clone) is None
+    hard_update(clone, actor)
+    assert torch.equal(clone.extract_parameters(), actor.extract_parameters())
+
+
+def test_parameters_past_the_first_storage_are_not_flat(make_args):
+    # Slices of one NumPy buffer are adjacent in memory, but every tensor made from them has its own storage
+    actor = Actor(make_args())
+    layout = flat_layout(actor)
+    buffer = np.zeros(sum(param.numel() for _, param in layout), dtype=np.float32)
+    offset = 0
+    for _, param in layout:
+        param.data = torch.from_numpy(buffer[offset:offset + param.numel()]).view_as(param)
+        offset += param.numel()
+    assert flat_parameters(actor) is None
+    clone = Actor(make_args())
+    hard_update(actor, clone)
+    assert torch.equal(actor.extract_parameters(), clone.extract_parameters())
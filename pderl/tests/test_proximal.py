@@ -0,0 +1,29 @@
+import pytest
+import torch
+from core.ddpg import Actor
+from core.mod_neuro_evo import SSNE
+from conftest import randomize
+
+
+@pytest.mark.parametrize('use_ln', [True, False])
+def test_output_sensitivity_matches_backward_per_action(make_args, use_ln):
+    torch.manual_seed(0)
+    args = make_args(state_dim=111, action_dim=8, use_ln=use_ln)
+    actors = [randomize(Actor(args)) for _ in range(4)]
+    # Two batch sizes, so two groups of actors
+    states = [torch.randn(size, args.state_dim) for size in (64, 64, 32, 64)]
+
+    expected = torch.stack([SSNE.backward_sensitivity(actor, state) for actor, state in zip(actors, states)])
+    sensitivity = SSNE.output_sensitivity(actors, states)
+    assert sensitivity.shape == (len(actors), actors[0].count_parameters())
+    torch.testing.assert_close(sensitivity, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_output_sensitivity_without_torch_func(make_args, monkeypatch):
+    torch.manual_seed(0)
+    args = make_args()
+    actors = [Actor(args) for _ in range(2)]
+    states = [torch.randn(16, args.state_dim) for _ in actors]
+    expected = SSNE.output_sensitivity(actors, states)
+    monkeypatch.delattr(torch, 'func', raising=False)
+    torch.testing.assert_close(SSNE.output_sensitivity(actors, states), expected, rtol=1e-5, atol=1e-6)
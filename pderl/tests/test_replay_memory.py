@@ -0,0 +1,369 @@
+import itertools
+import os
+import pickle
+import subprocess
+import sys
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import torch
+from core import replay_memory
+from core.agent import Agent
+from core.ddpg import DDPG, Actor, Critic
+from core.replay_memory import ReplayMemory, Transition
+
+STATE_DIM, ACTION_DIM = 4, 2
+
+
+def trajectory(rng, num, episode=7):
+    """
+    num transitions of episodes of about episode steps, the next state of a step is the state of the following
+    one except at the end of an episode. The values are exact in float16 so that every backend stores them as is.
+    """
+    states = rng.randn(num + 1, STATE_DIM).astype(np.float16).astype(np.float32)
+    done = rng.rand(num) < 1.0 / episode
+    next_states = states[1:].copy()
+    next_states[done] = rng.randn(done.sum(), STATE_DIM).astype(np.float16)
+    return Transition(states[:-1], rng.randn(num, ACTION_DIM).astype(np.float32), next_states,
+                      rng.randn(num, 1).astype(np.float32), done.reshape(-1, 1).astype(np.float32))
+
+
+BACKENDS = ['plain', 'float16', 'memmap', 'torch', 'dedup', 'prioritized']
+
+
+@pytest.fixture(params=BACKENDS)
+def make_memory(request, tmp_path):
+    """Factory of empty buffers of one of the backends"""
+    folders = itertools.count()
+
+    def make_memory(capacity):
+        if request.param == 'float16':
+            return ReplayMemory(capacity, 'cpu', np.float16)
+        if request.param == 'memmap':
+            return replay_memory.MemmapReplayMemory(capacity, 'cpu', str(tmp_path / str(next(folders))),
+                                                    cache_budget=1 << 10)
+        if request.param == 'torch':
+            return replay_memory.TorchReplayMemory(capacity, 'cpu')
+        if request.param == 'dedup':
+            return replay_memory.DedupReplayMemory(capacity, 'cpu')
+        if request.param == 'prioritized':
+            return replay_memory.PrioritizedReplayMemory(capacity, 'cpu')
+        return ReplayMemory(capacity, 'cpu')
+    return make_memory
+
+
+def content(memory):
+    """The transitions of a buffer as float32 arrays, oldest first"""
+    return [np.asarray(field, dtype=np.float32) for field in memory.get_latest(len(memory))]
+
+
+def assert_same_content(memory, reference):
+    assert len(memory) == len(reference)
+    for name, field, expected in zip(Transition._fields, content(memory), content(reference)):
+        np.testing.assert_array_equal(field.reshape(len(expected), -1), expected, err_msg=name)
+
+
+def fill(memory, reference, stream, rng, ops):
+    """
+    Applies a random sequence of add and extend to memory, the reference only sees adds
+    :param stream: an iterator of the transition rows to insert, consumed in order
+    """
+    capacity = memory.capacity
+    for _ in range(ops):
+        num = 1 if rng.rand() < 0.5 else rng.randint(0, 2 * capacity + 2)
+        rows = list(itertools.islice(stream, num))
+        if num == 1:
+            memory.add(*rows[0])
+        else:
+            memory.extend(*[np.array(field).reshape(num, -1) for field in zip(*rows)] if rows else
+                          [np.empty((0, 1)) for _ in Transition._fields])
+        for row in rows:
+            reference.add(*row)
+        yield
+
+
+def test_add_keeps_the_latest_transitions_in_order():
+    transitions = trajectory(np.random.RandomState(0), 50)
+    memory = ReplayMemory(13, 'cpu')
+    for step, row in enumerate(zip(*transitions)):
+        memory.add(*row)
+        start = max(0, step + 1 - 13)
+        assert len(memory) == step + 1 - start and memory.total == step + 1
+        for field, expected in zip(content(memory), transitions):
+            np.testing.assert_array_equal(field, expected[start:step + 1])
+
+
+def test_backend_matches_plain_memory(make_memory):
+    rng = np.random.RandomState(1)
+    memory, reference = make_memory(13), ReplayMemory(13, 'cpu')
+    stream = zip(*trajectory(rng, 2000))
+    for _ in fill(memory, reference, stream, rng, 60):
+        assert_same_content(memory, reference)
+        assert memory.total == reference.total
+        if len(memory) == 0:
+            continue
+
+        # Every sampled transition is one of the stored transitions
+        stored = {row.tobytes() for row in np.concatenate(content(reference), axis=1)}
+        batches = memory.sample_many(3, 5)
+        assert [tuple(field.shape) for field in batches] == [(3, 5, len(field[0])) for field in content(reference)]
+        for row in np.concatenate([field.reshape(15, -1).numpy() for field in batches], axis=1):
+            assert row.tobytes() in stored
+
+
+def test_copy_from_wraps_around(make_memory):
+    rng = np.random.RandomState(2)
+    source, reference_source = make_memory(17), ReplayMemory(17, 'cpu')
+    target, reference = make_memory(11), ReplayMemory(11, 'cpu')
+    stream = zip(*trajectory(rng, 4000))
+    for _ in fill(source, reference_source, stream, rng, 40):
+        latest = rng.randint(0, 20)
+        if rng.rand() < 0.2:
+            target.add_content_of(source)
+            latest = target.capacity
+        else:
+            target.copy_from(source, latest)
+        for row in zip(*reference_source.get_latest(latest)):
+            reference.add(*row)
+        assert_same_content(target, reference)
+
+
+def test_views_drop_evicted_transitions():
+    rng = np.random.RandomState(3)
+    transitions = trajectory(rng, 4000)
+    shared = ReplayMemory(20, 'cpu')
+    views = [replay_memory.ReplayView(shared, 8) for _ in range(2)]
+    expected = [[], []]  # Insertion numbers referenced by each view, oldest first
+    for _ in range(200):
+        index = rng.randint(2)
+        view, ids = views[index], expected[index]
+        if rng.rand() < 0.3:
+            latest = rng.randint(0, 10)
+            other = expected[1 - index]
+            if rng.rand() < 0.3:
+                view.add_content_of(views[1 - index])
+                latest = view.capacity
+            else:
+                view.copy_from(views[1 - index], latest)
+            ids += other[len(other) - min(latest, len(other)):]
+        else:
+            num = 1 if rng.rand() < 0.5 else rng.randint(1, 12)
+            block = [field[shared.total:shared.total + num] for field in transitions]
+            ids += list(range(shared.total, shared.total + num))
+            if num == 1:
+                shared.add(*[field[0] for field in block])
+                view.add(*[field[0] for field in block])
+            else:
+                shared.extend(*block)
+                view.extend(*block)
+
+        # The view keeps its last capacity references, then drops the ones the shared ring overwrote
+        for i in range(2):
+            expected[i] = [j for j in expected[i][-views[i].capacity:] if j >= shared.total - shared.capacity]
+            assert len(views[i]) == len(expected[i])
+            if not expected[i]:
+                continue
+            for field, stored in zip(views[i].get_latest(views[i].capacity), transitions):
+                np.testing.assert_array_equal(np.asarray(field, dtype=np.float32), stored[expected[i]])
+            for field, stored in zip(views[i].materialize().get_latest(views[i].capacity), transitions):
+                np.testing.assert_array_equal(np.asarray(field, dtype=np.float32), stored[expected[i]])
+
+
+def test_prioritized_sampling_follows_the_priorities():
+    rng = np.random.RandomState(4)
+    np.random.seed(4)
+    memory = replay_memory.PrioritizedReplayMemory(16, 'cpu', alpha=0.7, beta_start=0.5, beta_frames=1000)
+    memory.extend(*trajectory(rng, 10))
+    errors = rng.exponential(size=10)
+    memory.update_priorities(np.arange(10), errors)
+    priorities = (errors + 1e-5) ** 0.7
+    probs = priorities / priorities.sum()
+
+    counts = np.zeros(16)
+    for frame in range(1, 501):
+        batch, indices, weights = memory.sample(32)
+        assert indices.max() < 10
+        for field, expected in zip(batch, memory._fetch(indices)):
+            np.testing.assert_array_equal(field.numpy(), expected)
+
+        # Importance sampling weights normalised by the largest possible weight
+        beta = min(1.0, 0.5 + frame * 0.5 / 1000)
+        expected = (10 * probs[indices]) ** -beta / (10 * probs.min()) ** -beta
+        np.testing.assert_allclose(weights.numpy(), expected, rtol=1e-5)
+        counts += np.bincount(indices, minlength=16)
+
+    # The sampling is stratified, so the frequencies are close to the probabilities
+    np.testing.assert_allclose(counts[:10] / counts.sum(), probs, atol=5e-3)
+
+
+def test_prioritized_trees_follow_the_updates():
+    rng = np.random.RandomState(5)
+    memory = replay_memory.PrioritizedReplayMemory(8, 'cpu', alpha=0.6)
+    priorities = np.zeros(8)  # Priority of each slot, new transitions get the largest priority seen so far
+    largest = 1.0
+    stream = zip(*trajectory(rng, 1000))
+    for _ in range(100):
+        if len(memory) == 0 or rng.rand() < 0.5:
+            num = rng.randint(1, 20)
+            start = memory.total
+            rows = list(itertools.islice(stream, num))
+            if num == 1:
+                memory.add(*rows[0])
+            else:
+                memory.extend(*[np.array(field).reshape(num, -1) for field in zip(*rows)])
+            priorities[np.arange(max(start, memory.total - 8), memory.total) % 8] = largest
+        else:
+            indices = rng.choice(len(memory), size=rng.randint(1, len(memory) + 1), replace=False)
+            errors = rng.exponential(size=len(indices)) * 3
+            memory.update_priorities(indices, errors.reshape(-1, 1))
+            priorities[indices] = (errors + 1e-5) ** 0.6
+            largest = max(largest, priorities[indices].max())
+
+        np.testing.assert_allclose(memory.sum_tree[np.arange(8)], priorities)
+        np.testing.assert_allclose(memory.sum_tree.sum(), priorities.sum())
+        np.testing.assert_allclose(memory.min_tree.min(), priorities[:len(memory)].min())
+        assert memory.max_priority == pytest.approx(largest)
+
+    memory.reset()
+    assert len(memory) == 0 and memory.sum_tree.sum() == 0
+
+
+class RecordingMemory(replay_memory.PrioritizedReplayMemory):
+    def update_priorities(self, batch_indices, batch_priorities):
+        self.updates.append((np.array(batch_indices), batch_priorities))
+        super().update_priorities(batch_indices, batch_priorities)
+
+
+def test_per_training_sets_the_priorities_to_the_td_errors(make_args):
+    rng = np.random.RandomState(6)
+    args = make_args(state_dim=STATE_DIM, action_dim=ACTION_DIM)
+    args.individual_bs, args.dedup_obs, args.obs_dtype = 100, False, np.float32
+    args.gamma, args.tau, args.use_done_mask = 0.99, 0.001, True
+    args.per, args.prefetch, args.batch_size, args.frac_frames_train = True, False, 16, 1.0
+    memory = RecordingMemory(200, 'cpu', alpha=0.7)
+    memory.updates = []
+    memory.extend(*trajectory(rng, 150))
+
+    agent = SimpleNamespace(args=args, replay_buffer=memory, rl_agent=DDPG(args), gen_frames=5)
+    losses = Agent.train_ddpg(agent)
+    assert len(losses['pgs_loss']) == 5 and len(memory.updates) == 5
+
+    leaves = {}
+    for indices, errors in memory.updates:
+        assert isinstance(errors, np.ndarray) and errors.shape == (16, 1) and (errors >= 0).all()
+        leaves.update(zip(indices, errors.reshape(-1)))
+    slots = np.array(list(leaves))
+    np.testing.assert_allclose(memory.sum_tree[slots], (np.array(list(leaves.values())) + 1e-5) ** 0.7, rtol=1e-6)
+
+
+def assert_chain_ends(memory):
+    """Only the slots whose next state is not the state of the following slot keep it aside"""
+    state, _, next_state, _, _ = content(memory)
+    ends = np.ones(len(state), dtype=np.bool_)
+    ends[:-1] = np.any(next_state[:-1] != state[1:], axis=1)
+    order = memory._latest_indices(len(memory))
+    np.testing.assert_array_equal(memory.last[order], ends)
+    assert sorted(memory.final) == sorted(order[ends])
+
+
+def test_dedup_next_states_across_episodes_and_wrap():
+    rng = np.random.RandomState(7)
+    memory, reference = replay_memory.DedupReplayMemory(13, 'cpu'), ReplayMemory(13, 'cpu')
+
+    # Runs of two interleaved trajectories, as the episodes of different individuals reach the buffer
+    sources = [zip(*trajectory(rng, 3000, episode=5)) for _ in range(2)]
+    stream = itertools.chain.from_iterable(itertools.islice(sources[rng.randint(2)], rng.randint(1, 9))
+                                           for _ in itertools.count())
+    for _ in fill(memory, reference, stream, rng, 150):
+        assert_same_content(memory, reference)
+        assert_chain_ends(memory)
+
+    # Shuffling moves whole chains, the transitions stay the same
+    memory.shuffle()
+    assert_chain_ends(memory)
+    rows = [np.concatenate(fields, axis=1) for fields in (content(memory), content(reference))]
+    np.testing.assert_array_equal(*[row[np.lexsort(row.T)] for row in rows])
+
+
+@pytest.mark.parametrize('staging_size', [1, 5, 1000])
+def test_staging_matches_step_by_step_insertion(make_memory, staging_size):
+    rng = np.random.RandomState(8)
+    memory, reference = make_memory(23), ReplayMemory(23, 'cpu')
+    view, reference_view = replay_memory.ReplayView(memory, 9), ReplayMemory(9, 'cpu')
+    staging = replay_memory.EpisodeStaging(staging_size)
+    for _ in range(6):
+        # Steps as evaluate stages them: a (1, dim) action from the policy, scalar reward and done flag
+        for state, action, next_state, reward, done in zip(*trajectory(rng, rng.randint(1, 15))):
+            staging.add(state, action.reshape(1, -1), next_state, float(reward[0]), float(done[0]))
+            if staging.full():
+                staging.flush(memory, view)
+            for buffer in (reference, reference_view):
+                buffer.add(state, action, next_state, reward, done)
+        staging.flush(memory, view)
+        assert staging.size == 0
+        assert_same_content(memory, reference)
+        assert_same_content(view, reference_view)
+
+
+def test_torch_memory_reuses_the_batch_tensors():
+    memory = replay_memory.TorchReplayMemory(50, 'cpu', np.float16)
+    transitions = trajectory(np.random.RandomState(9), 40)
+    memory.extend(*transitions)
+    pointers = [field.data_ptr() for field in memory.sample_many(4, 8)]
+    second = memory.sample_many(4, 8)
+    assert [field.data_ptr() for field in second] == pointers
+
+    # The float16 observations are decoded into the float32 batches
+    stored = {row.tobytes() for row in np.concatenate(transitions, axis=1)}
+    for row in np.concatenate([field.reshape(32, -1).numpy() for field in second], axis=1):
+        assert row.dtype == np.float32 and row.tobytes() in stored
+    assert [field.data_ptr() for field in memory.sample(32)] == pointers
+    assert [field.data_ptr() for field in memory.sample_many(4, 8, rng=np.random)] != pointers
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_snapshot_round_trip(make_memory, tmp_path, compressed):
+    rng = np.random.RandomState(10)
+    memory, reference = make_memory(13), ReplayMemory(13, 'cpu')
+    for _ in fill(memory, reference, zip(*trajectory(rng, 200)), rng, 8):
+        pass
+    path = str(tmp_path / 'snapshot.npz')
+    memory.save(path, compressed)
+
+    # Loading replaces the content, the oldest transition comes first whatever the ring position was
+    loaded = make_memory(13)
+    loaded.extend(*trajectory(rng, 5))
+    loaded.load(path)
+    assert_same_content(loaded, reference)
+    assert loaded.position == len(reference) % 13
+
+    smaller = ReplayMemory(4, 'cpu')
+    smaller.load(path)
+    for field, expected in zip(content(smaller), content(reference)):
+        np.testing.assert_array_equal(field, expected[-4:])
+
+
+def test_convert_folder_of_legacy_buffers(make_args, tmp_path):
+    rng = np.random.RandomState(11)
+    transitions = list(zip(*trajectory(rng, 30)))
+    reference = ReplayMemory(20, 'cpu')
+    for row in transitions:
+        reference.add(*row)
+
+    # A buffer pickled by the list based ReplayMemory, full and wrapped, next to the torch.save checkpoints
+    legacy = object.__new__(ReplayMemory)
+    legacy.__dict__.update(device='cpu', capacity=20, position=10, memory=[
+        Transition(*[np.reshape(field, (1, -1)) for field in row]) for row in transitions[20:] + transitions[10:20]])
+    with open(str(tmp_path / 'champion_buffer_10.pkl'), 'wb') as f:
+        pickle.dump(legacy, f)
+    args = make_args(state_dim=STATE_DIM, action_dim=ACTION_DIM)
+    torch.save(Actor(args).state_dict(), str(tmp_path / 'evo_net_actor_10.pkl'))
+    torch.save(Critic(args).state_dict(), str(tmp_path / 'evo_net_critic_10.pkl'))
+
+    subprocess.check_call([sys.executable, 'convert_buffer.py', '-source', str(tmp_path)],
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert sorted(os.listdir(str(tmp_path))) == ['champion_buffer_10.npz', 'champion_buffer_10.pkl',
+                                                 'evo_net_actor_10.pkl', 'evo_net_critic_10.pkl']
+    converted = ReplayMemory(20, 'cpu')
+    converted.load(str(tmp_path / 'champion_buffer_10.npz'))
+    assert_same_content(converted, reference)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+from core.ddpg import Actor
+from core.rollout_workers import RolloutPool
+from conftest import Gene, randomize
+
+
+class ToyEnv:
+    """Deterministic given its seed, its step fails for the episodes seeded with failing_seed"""
+
+    def __init__(self, failing_seed=None, state_dim=11):
+        self.failing_seed = failing_seed
+        self.state_dim = state_dim
+
+    def seed(self, seed):
+        self.seed_value = seed
+
+    def reset(self):
+        self.rng = np.random.RandomState(self.seed_value)
+        self.steps = 0
+        self.state = self.rng.randn(self.state_dim)
+        return self.state.copy()
+
+    def step(self, action):
+        if self.seed_value == self.failing_seed:
+            raise ValueError('Failing episode')
+        self.steps += 1
+        self.state = np.tanh(self.state + 0.1 * action.sum() + 0.05 * self.rng.randn(self.state_dim))
+        return self.state.copy(), float(action[0] - np.sum(self.state ** 2)), self.steps >= 20 + self.seed_value % 7, {}
+
+
+def play(actor, seed):
+    env = ToyEnv()
+    env.seed(seed)
+    policy = actor.numpy_policy()
+    state, done, total = env.reset(), False, 0.0
+    while not done:
+        state, reward, done, _ = env.step(policy.select_action(state).flatten())
+        total += reward
+    return total
+
+
+def test_failed_episode_leaves_no_result_behind(make_args):
+    torch.manual_seed(0)
+    args = make_args()
+    agents = [Gene(randomize(Actor(args))) for _ in range(3)]
+    pool = RolloutPool(args, lambda: ToyEnv(failing_seed=args.seed + 2), 3, 3, 100)
+    try:
+        with pytest.raises(ValueError):
+            pool.evaluate(agents, 2)
+
+        # The next call only gets the results of its own episodes, seeded after the ones of the failed call
+        episodes = pool.evaluate(agents, 2)
+        seeds = args.seed + 6 + 1 + np.arange(6)
+        for episode, seed in zip(episodes, seeds):
+            assert episode['reward'] == pytest.approx(play(agents[episode['index']].actor, int(seed)), rel=1e-5)
+            assert len(episode['transitions'].reward) == 20 + seed % 7
+    finally:
+        pool.close()